@@ -0,0 +1,538 @@
+"""
+All-pairs chemical similarity of compounds from folded Morgan fingerprints.
+
+Fingerprints are folded to `n_bits` bits and packed eight bits per byte, so
+20k compounds take a few megabytes. Similarities are computed a block of
+compounds at a time: a block is unpacked to a 0/1 float32 matrix and the
+intersections with every other compound are a single matrix product.
+Blocks can be spread across processes. `SimilarityStore` keeps the
+resulting matrix compactly on disk for lookups by pert_id.
+
+Folded bit fingerprints give Dice and Tanimoto similarities on the presence
+of features. These differ from `rdkit.DataStructs.DiceSimilarity` on the
+count-based fingerprints of `GetMorganFingerprint`, which also weights
+feature counts.
+"""
+import multiprocessing
+
+import numpy
+
+def get_morgan_fingerprints(inchis, radius=2):
+    """
+    Compute count-based Morgan fingerprints for a sequence of InChI strings.
+    Requires rdkit.
+    """
+    import rdkit.Chem
+    import rdkit.Chem.AllChem
+    fingerprints = list()
+    for inchi in inchis:
+        mol = rdkit.Chem.MolFromInchi(inchi)
+        fingerprints.append(rdkit.Chem.AllChem.GetMorganFingerprint(mol, radius))
+    return fingerprints
+
+class FingerprintCache(object):
+    """
+    Packed folded Morgan fingerprints stored in a sqlite database, keyed by
+    InChIKey, radius and number of bits. Only fingerprints missing from the
+    cache are computed, in parallel across processes, so reruns and new
+    compound batches do not recompute known compounds.
+    """
+    def __init__(self, path, radius=2, n_bits=2048):
+        """Open or create the cache at `path` for the fingerprint parameters."""
+        import sqlite3
+        if n_bits % 8:
+            raise ValueError('n_bits must be a multiple of 8')
+        self.radius = radius
+        self.n_bits = n_bits
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            'inchi_key TEXT, radius INTEGER, n_bits INTEGER, fingerprint BLOB, '
+            'PRIMARY KEY (inchi_key, radius, n_bits))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_cached(self, inchi_keys):
+        """
+        Return a dictionary of InChIKey to packed fingerprint (a uint8 array)
+        for the `inchi_keys` in the cache.
+        """
+        inchi_keys = list(inchi_keys)
+        cached = dict()
+        for start in range(0, len(inchi_keys), 500):
+            chunk = inchi_keys[start:start + 500]
+            query = ('SELECT inchi_key, fingerprint FROM fingerprints '
+                     'WHERE radius = ? AND n_bits = ? AND inchi_key IN ({})').format(
+                         ','.join('?' * len(chunk)))
+            for inchi_key, blob in self.connection.execute(query, [self.radius, self.n_bits] + chunk):
+                cached[inchi_key] = numpy.frombuffer(blob, dtype=numpy.uint8)
+        return cached
+
+    def get_packed(self, inchis, inchi_keys, n_jobs=1):
+        """
+        Return a packed fingerprint array with a row for each of `inchis`,
+        whose InChIKeys are `inchi_keys`. Missing fingerprints are computed on
+        `n_jobs` processes (-1 for all cores) and stored in a single
+        transaction. Computing a fingerprint checks that the InChIKey of its
+        InChI matches. Requires rdkit for missing fingerprints only.
+        """
+        import sqlite3
+        inchis, inchi_keys = list(inchis), list(inchi_keys)
+        cached = self.get_cached(inchi_keys)
+        missing = {key: inchi for key, inchi in zip(inchi_keys, inchis) if key not in cached}
+        tasks = [(inchi, key, self.radius, self.n_bits) for key, inchi in missing.items()]
+        if tasks:
+            if n_jobs == -1:
+                n_jobs = multiprocessing.cpu_count()
+            if n_jobs == 1:
+                results = [_fingerprint_worker(task) for task in tasks]
+            else:
+                pool = multiprocessing.Pool(n_jobs)
+                try:
+                    results = pool.map(_fingerprint_worker, tasks, chunksize=64)
+                finally:
+                    pool.terminate()
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO fingerprints VALUES (?,?,?,?)',
+                    ((key, self.radius, self.n_bits, sqlite3.Binary(packed.tobytes()))
+                     for key, packed in results))
+            cached.update(results)
+        return numpy.array([cached[key] for key in inchi_keys], dtype=numpy.uint8).reshape(
+            len(inchi_keys), self.n_bits // 8)
+
+def _fingerprint_worker(task):
+    """Compute the packed folded Morgan fingerprint of an InChI."""
+    import rdkit.Chem.inchi
+    inchi, inchi_key, radius, n_bits = task
+    if rdkit.Chem.inchi.InchiToInchiKey(inchi) != inchi_key:
+        raise ValueError('InChIKey {} does not match its InChI'.format(inchi_key))
+    fingerprint, = get_morgan_fingerprints([inchi], radius)
+    return inchi_key, fold_fingerprints([fingerprint], n_bits)[0]
+
+def fold_fingerprints(fingerprints, n_bits=2048):
+    """
+    Fold rdkit fingerprints into a compound (rows) by byte (columns) array of
+    packed bits. Count-based sparse fingerprints (such as those from
+    `GetMorganFingerprint`) set bit `feature % n_bits` for each of their
+    features, as `GetMorganFingerprintAsBitVect` does. Bit vectors must have
+    `n_bits` bits.
+    """
+    if n_bits % 8:
+        raise ValueError('n_bits must be a multiple of 8')
+    bits = numpy.zeros((len(fingerprints), n_bits), dtype=bool)
+    for i, fingerprint in enumerate(fingerprints):
+        if hasattr(fingerprint, 'GetNonzeroElements'):
+            features = list(fingerprint.GetNonzeroElements())
+        else:
+            features = list(fingerprint.GetOnBits())
+        bits[i, numpy.asarray(features, dtype=numpy.int64) % n_bits] = True
+    return numpy.packbits(bits, axis=1)
+
+def count_bits(packed):
+    """Number of bits set in each row of a packed fingerprint array."""
+    return numpy.unpackbits(packed, axis=1).sum(axis=1, dtype=numpy.int64)
+
+def similarity_block(packed_rows, packed_columns, metric='dice',
+                     row_counts=None, column_counts=None):
+    """
+    Similarities between each row of `packed_rows` and each row of
+    `packed_columns`, both packed fingerprint arrays, as a float32 array.
+    `metric` is 'dice' or 'tanimoto'. Compounds without bits have a
+    similarity of 0, as in rdkit.
+    """
+    rows = numpy.unpackbits(packed_rows, axis=1).astype(numpy.float32)
+    columns = numpy.unpackbits(packed_columns, axis=1).astype(numpy.float32)
+    if row_counts is None:
+        row_counts = rows.sum(axis=1)
+    if column_counts is None:
+        column_counts = columns.sum(axis=1)
+    return _unpacked_similarity_block(rows, columns, metric, row_counts, column_counts)
+
+def _unpacked_similarity_block(rows, columns, metric, row_counts, column_counts):
+    """`similarity_block` for fingerprints unpacked to 0/1 float32 arrays."""
+    intersections = numpy.dot(rows, columns.T)
+    totals = numpy.add.outer(numpy.asarray(row_counts, dtype=numpy.float32),
+                             numpy.asarray(column_counts, dtype=numpy.float32))
+    if metric == 'dice':
+        numerators, denominators = 2 * intersections, totals
+    elif metric == 'tanimoto':
+        numerators, denominators = intersections, totals - intersections
+    else:
+        raise ValueError("metric must be 'dice' or 'tanimoto'")
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        similarities = numerators / denominators
+    similarities[denominators == 0] = 0
+    return similarities
+
+def get_similarity_matrix(packed, metric='dice', block_size=1024, n_jobs=1):
+    """
+    Compute the dense compound by compound float32 similarity matrix of a
+    packed fingerprint array, `block_size` rows at a time on `n_jobs`
+    processes (-1 for all cores).
+    """
+    n = len(packed)
+    matrix = numpy.empty((n, n), dtype=numpy.float32)
+    for start, block in _map_blocks(packed, metric, block_size, n_jobs, upper=False):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+def iter_similarity_pairs(packed, metric='dice', block_size=1024, n_jobs=1,
+                          upper=True, threshold=None):
+    """
+    Yield the compound pairs of a packed fingerprint array as a tuple of row
+    positions, column positions and similarities for each block of
+    `block_size` rows. If `upper`, only pairs with row < column are yielded,
+    otherwise all ordered pairs including self pairs. If `threshold` is
+    given, only pairs with a similarity of at least `threshold` are yielded.
+    Blocks are computed on `n_jobs` processes (-1 for all cores) and yielded
+    in order.
+    """
+    for start, block in _map_blocks(packed, metric, block_size, n_jobs, upper):
+        column_start = start if upper else 0
+        keep = numpy.ones(block.shape, dtype=bool)
+        if upper:
+            keep = numpy.triu(keep, k=1)
+        if threshold is not None:
+            keep &= block >= threshold
+        rows, columns = numpy.nonzero(keep)
+        yield rows + start, columns + column_start, block[rows, columns]
+
+def _map_blocks(packed, metric, block_size, n_jobs, upper):
+    """
+    Yield (row start, similarity block) for each block of `block_size` rows
+    of `packed`. With `upper`, a block only spans the columns from its first
+    row onwards.
+    """
+    packed = numpy.ascontiguousarray(packed, dtype=numpy.uint8)
+    tasks = [(start, block_size, metric, upper) for start in range(0, len(packed), block_size)]
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1:
+        counts = count_bits(packed)
+        for start, block_size, metric, upper in tasks:
+            yield _compute_block(packed, counts, start, block_size, metric, upper)
+        return
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(packed,))
+    try:
+        for result in pool.imap(_similarity_worker, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+def _compute_block(packed, counts, start, block_size, metric, upper):
+    """Compute the block of rows of the similarity matrix starting at `start`."""
+    stop = min(start + block_size, len(packed))
+    column_start = start if upper else 0
+    block = similarity_block(packed[start:stop], packed[column_start:], metric,
+                             counts[start:stop], counts[column_start:])
+    return start, block
+
+# packed fingerprints and their bit counts, set in each worker process
+_worker_state = {}
+
+def _init_worker(packed):
+    """Share the packed fingerprints with the blocks computed by this process."""
+    _worker_state['packed'] = packed
+    _worker_state['counts'] = count_bits(packed)
+
+def _similarity_worker(task):
+    """Compute one block of rows of the similarity matrix in a worker process."""
+    return _compute_block(_worker_state['packed'], _worker_state['counts'], *task)
+
+class SimilarityStore(object):
+    """
+    Compound similarities stored as the upper triangle (with the diagonal)
+    of the similarity matrix, quantized to uint16 and memory-mapped from
+    `path + '.npy'`. Similarities are multiples of 1 / 65535, which is finer
+    than the four decimals of the `similarities` table. Compounds are
+    indexed by `pert_uid` and `pert_id` in `path + '-index.tsv'`.
+    """
+    scale = 65535
+
+    def __init__(self, path):
+        """Open the store at `path` for reading."""
+        import pandas
+        self.path = path
+        self.index_df = pandas.read_table(path + '-index.tsv', dtype={'pert_id': str})
+        self.triangle = numpy.load(path + '.npy', mmap_mode='r')
+        self.n = len(self.index_df)
+        self._pert_id_positions = pandas.Index(self.index_df.pert_id)
+
+    @classmethod
+    def build(cls, path, packed, pert_uids, pert_ids, metric='dice',
+              block_size=1024, n_jobs=1):
+        """
+        Compute the similarities of the compounds of a packed fingerprint
+        array, whose rows are the compounds with `pert_uids` and `pert_ids`,
+        and write them to a store at `path`. Returns the opened store.
+        """
+        import pandas
+        n = len(packed)
+        index_df = pandas.DataFrame({'position': numpy.arange(n), 'pert_uid': list(pert_uids),
+                                     'pert_id': list(pert_ids)})
+        index_df.to_csv(path + '-index.tsv', sep='\t', index=False,
+                        columns=['position', 'pert_uid', 'pert_id'])
+        triangle = numpy.lib.format.open_memmap(
+            path + '.npy', mode='w+', dtype=numpy.uint16, shape=(n * (n + 1) // 2,))
+        offsets = _triangle_offsets(numpy.arange(n), n)
+        for start, block in _map_blocks(packed, metric, block_size, n_jobs, upper=True):
+            quantized = numpy.round(block * cls.scale).astype(numpy.uint16)
+            for row in range(len(block)):
+                i = start + row
+                triangle[offsets[i]:offsets[i] + n - i] = quantized[row, row:]
+        triangle.flush()
+        del triangle
+        return cls(path)
+
+    def get_positions(self, pert_ids):
+        """Positions of `pert_ids` in the store, dropping unknown pert_ids."""
+        positions = self._pert_id_positions.get_indexer(list(pert_ids))
+        return positions[positions >= 0]
+
+    def get_values(self, positions_0, positions_1):
+        """Similarities between compounds at paired arrays of positions."""
+        positions_0 = numpy.asarray(positions_0, dtype=numpy.int64)
+        positions_1 = numpy.asarray(positions_1, dtype=numpy.int64)
+        low = numpy.minimum(positions_0, positions_1)
+        high = numpy.maximum(positions_0, positions_1)
+        cells = _triangle_offsets(low, self.n) + high - low
+        # reading cells in file order touches each page once
+        order = numpy.argsort(cells, kind='mergesort')
+        values = numpy.empty(len(cells), dtype=numpy.float32)
+        values[order] = self.triangle[cells[order]]
+        return values / self.scale
+
+    def get_submatrix(self, pert_ids):
+        """
+        Return a pert_id by pert_id dataframe of similarities between the
+        known `pert_ids`.
+        """
+        import pandas
+        positions = self.get_positions(pert_ids)
+        grid_0, grid_1 = numpy.meshgrid(positions, positions, indexing='ij')
+        values = self.get_values(grid_0.ravel(), grid_1.ravel())
+        labels = self.index_df.pert_id.values[positions]
+        return pandas.DataFrame(values.reshape(grid_0.shape), index=labels, columns=labels)
+
+    def get_pairs(self, pert_ids):
+        """
+        Return a dataframe with a row for each ordered pair of the known
+        `pert_ids`, self pairs included, with `pert_id_0`, `pert_id_1` and
+        `chemical` columns as in the `similarities` table join.
+        """
+        import pandas
+        positions = self.get_positions(pert_ids)
+        grid_0, grid_1 = numpy.meshgrid(positions, positions, indexing='ij')
+        grid_0, grid_1 = grid_0.ravel(), grid_1.ravel()
+        pert_id_array = self.index_df.pert_id.values
+        return pandas.DataFrame({
+            'pert_id_0': pert_id_array[grid_0],
+            'pert_id_1': pert_id_array[grid_1],
+            'chemical': self.get_values(grid_0, grid_1),
+        }, columns=['pert_id_0', 'pert_id_1', 'chemical'])
+
+    def export_sqlite(self, connection, table='similarities', block_size=256):
+        """
+        Insert every ordered pair of compounds, self pairs included, into
+        `table` (`pert_uid_0`, `pert_uid_1`, `chemical`) of a sqlite3
+        `connection`, rounding similarities to four decimals. The rows are
+        inserted in a single transaction, `block_size` compounds at a time.
+        """
+        pert_uids = numpy.asarray(self.index_df.pert_uid)
+        query = 'INSERT INTO {} VALUES (?,?,?)'.format(table)
+        columns = numpy.arange(self.n)
+        with connection:
+            for start in range(0, self.n, block_size):
+                rows = numpy.arange(start, min(start + block_size, self.n))
+                grid_0 = numpy.repeat(rows, self.n)
+                grid_1 = numpy.tile(columns, len(rows))
+                values = numpy.round(self.get_values(grid_0, grid_1).astype(numpy.float64), 4)
+                records = zip(pert_uids[grid_0].tolist(), pert_uids[grid_1].tolist(), values.tolist())
+                connection.executemany(query, records)
+
+def _triangle_offsets(rows, n):
+    """Position of the diagonal cell of each of `rows` in the upper triangle."""
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    return rows * n - rows * (rows - 1) // 2
+
+class NeighborIndex(object):
+    """
+    Top-k most similar compounds by Dice or Tanimoto similarity of packed
+    fingerprints. Compounds are kept sorted by their number of set bits.
+    A query with `a` bits cannot be more similar than `min(a, b) / max(a, b)`
+    (Tanimoto) or `2 * min(a, b) / (a + b)` (Dice) to a compound with `b`
+    bits, so candidates are scanned in bands outward from the query's bit
+    count. The scan stops once neither neighbouring band can beat the k-th
+    best similarity found. Queries with similar bit counts are processed
+    together, so each band is a single block product.
+    """
+    def __init__(self, packed, ids, metric='dice', radius=2, band_size=1024):
+        """
+        Index the compounds of a packed fingerprint array with `ids`. `radius`
+        is the Morgan radius used for fingerprints of queried InChIs.
+        """
+        if metric not in ('dice', 'tanimoto'):
+            raise ValueError("metric must be 'dice' or 'tanimoto'")
+        self.metric = metric
+        self.radius = radius
+        self.band_size = band_size
+        self.packed = numpy.zeros((0, packed.shape[1]), dtype=numpy.uint8)
+        self.ids = numpy.zeros(0, dtype=object)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.add(packed, ids)
+
+    def add(self, packed, ids):
+        """
+        Add compounds to the index. Existing compounds are not recomputed;
+        only the bit count order is merged.
+        """
+        packed = numpy.ascontiguousarray(packed, dtype=numpy.uint8)
+        if packed.shape[1] != self.packed.shape[1]:
+            raise ValueError('fingerprints must have {} bytes'.format(self.packed.shape[1]))
+        packed = numpy.concatenate([self.packed, packed])
+        ids = numpy.concatenate([self.ids, numpy.array(list(ids), dtype=object)])
+        counts = numpy.concatenate([self.counts, count_bits(packed[len(self.packed):])])
+        order = numpy.argsort(counts, kind='mergesort')
+        self.packed, self.ids, self.counts = packed[order], ids[order], counts[order]
+        self._id_to_position = {compound_id: i for i, compound_id in enumerate(self.ids.tolist())}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _get_bounds(self, query_counts, candidate_count):
+        """Largest possible similarity of each query to a candidate bit count."""
+        query_counts = query_counts.astype(numpy.float64)
+        smaller = numpy.minimum(query_counts, candidate_count)
+        if self.metric == 'dice':
+            totals = query_counts + candidate_count
+        else:
+            totals = numpy.maximum(query_counts, candidate_count)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            bounds = (1 + (self.metric == 'dice')) * smaller / totals
+        # compounds without bits have a similarity of 0
+        return numpy.where(totals == 0, 0.0, bounds)
+
+    def query(self, packed_queries, k=10, exclude=None, batch_size=256):
+        """
+        Find the `k` most similar indexed compounds to each row of a packed
+        fingerprint array. `exclude` optionally gives, for each query, the
+        position of an indexed compound to skip (-1 for none), such as the
+        query itself. Returns arrays of positions and similarities with a
+        row per query, most similar first; rows are padded with position -1
+        and similarity -inf when fewer than `k` compounds are available.
+        The number of similarities computed is stored in
+        `self.n_candidates`.
+        """
+        packed_queries = numpy.ascontiguousarray(packed_queries, dtype=numpy.uint8)
+        n_queries = len(packed_queries)
+        if exclude is None:
+            exclude = numpy.full(n_queries, -1, dtype=numpy.int64)
+        query_counts = count_bits(packed_queries)
+        positions = numpy.full((n_queries, k), -1, dtype=numpy.int64)
+        similarities = numpy.full((n_queries, k), -numpy.inf, dtype=numpy.float32)
+        self.n_candidates = 0
+        order = numpy.argsort(query_counts, kind='mergesort')
+        for start in range(0, n_queries, batch_size):
+            group = order[start:start + batch_size]
+            group_positions, group_similarities = self._query_group(
+                packed_queries[group], query_counts[group], exclude[group], k)
+            positions[group] = group_positions
+            similarities[group] = group_similarities
+        return positions, similarities
+
+    def _query_group(self, packed_queries, query_counts, exclude, k):
+        """Top-k search for queries with nearby bit counts."""
+        n = len(self.ids)
+        best_positions = numpy.full((len(packed_queries), k), -1, dtype=numpy.int64)
+        best_similarities = numpy.full((len(packed_queries), k), -numpy.inf, dtype=numpy.float32)
+        low = numpy.searchsorted(self.counts, query_counts.min(), side='left')
+        high = numpy.searchsorted(self.counts, query_counts.max(), side='right')
+        band = (low, high)
+        active = numpy.ones(len(packed_queries), dtype=bool)
+        unpacked_queries = numpy.unpackbits(packed_queries, axis=1).astype(numpy.float32)
+        while True:
+            rows = numpy.flatnonzero(active)
+            if band[1] > band[0] and len(rows):
+                candidates = numpy.arange(band[0], band[1])
+                unpacked_band = numpy.unpackbits(self.packed[band[0]:band[1]], axis=1)
+                block = _unpacked_similarity_block(
+                    unpacked_queries[rows], unpacked_band.astype(numpy.float32), self.metric,
+                    query_counts[rows], self.counts[band[0]:band[1]])
+                block[candidates[numpy.newaxis, :] == exclude[rows, numpy.newaxis]] = -numpy.inf
+                self.n_candidates += block.size
+                best_positions[rows], best_similarities[rows] = _merge_top_k(
+                    best_positions[rows], best_similarities[rows],
+                    numpy.broadcast_to(candidates, block.shape), block, k)
+            # extend towards the next band only for queries it may improve.
+            # Bounds shrink away from the query bit counts, so a query that
+            # cannot improve from a band cannot improve from any beyond it
+            kth_best = best_similarities[:, -1]
+            if low > 0:
+                active = self._get_bounds(query_counts, self.counts[low - 1]) >= kth_best
+                if active.any():
+                    band = (max(0, low - self.band_size), low)
+                    low = band[0]
+                    continue
+            if high < n:
+                active = self._get_bounds(query_counts, self.counts[high]) >= kth_best
+                if active.any():
+                    band = (high, min(n, high + self.band_size))
+                    high = band[1]
+                    continue
+            break
+        best_positions[~numpy.isfinite(best_similarities)] = -1
+        return best_positions, best_similarities
+
+    def _to_df(self, query_ids, positions, similarities):
+        """Tidy dataframe of query results, without padding."""
+        import pandas
+        n_queries, k = positions.shape
+        found = positions >= 0
+        return pandas.DataFrame({
+            'query': numpy.repeat(numpy.asarray(query_ids, dtype=object), k).reshape(n_queries, k)[found],
+            'neighbor': self.ids[positions[found]],
+            'rank': numpy.tile(numpy.arange(1, k + 1), n_queries).reshape(n_queries, k)[found],
+            'similarity': similarities[found],
+        }, columns=['query', 'neighbor', 'rank', 'similarity'])
+
+    def query_ids(self, ids, k=10):
+        """
+        Return a dataframe of the `k` nearest neighbors of indexed compounds,
+        excluding each compound itself.
+        """
+        ids = list(ids)
+        query_positions = numpy.array([self._id_to_position[x] for x in ids], dtype=numpy.int64)
+        positions, similarities = self.query(self.packed[query_positions], k, exclude=query_positions)
+        return self._to_df(ids, positions, similarities)
+
+    def query_inchis(self, inchis, k=10):
+        """
+        Return a dataframe of the `k` nearest neighbors of compounds given
+        as InChI strings. Requires rdkit.
+        """
+        inchis = list(inchis)
+        fingerprints = get_morgan_fingerprints(inchis, self.radius)
+        packed = fold_fingerprints(fingerprints, self.packed.shape[1] * 8)
+        positions, similarities = self.query(packed, k)
+        return self._to_df(inchis, positions, similarities)
+
+    def all_neighbors(self, k=10):
+        """
+        Return a dataframe of the `k` nearest neighbors of every indexed
+        compound, excluding each compound itself.
+        """
+        return self.query_ids(self.ids, k)
+
+def _merge_top_k(positions, similarities, new_positions, new_similarities, k):
+    """Keep the `k` most similar of current and new candidates, sorted."""
+    positions = numpy.concatenate([positions, new_positions], axis=1)
+    similarities = numpy.concatenate([similarities, new_similarities], axis=1)
+    rows = numpy.arange(len(positions))[:, numpy.newaxis]
+    if similarities.shape[1] > k:
+        top = numpy.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        positions, similarities = positions[rows, top], similarities[rows, top]
+    order = numpy.argsort(-similarities, axis=1, kind='mergesort')
+    return positions[rows, order], similarities[rows, order]
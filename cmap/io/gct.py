@@ -5,8 +5,8 @@ provides .gct file io modules
 @author: cflynn
 '''
 import csv
+import operator
 import os
-import sqlite3
 import warnings
 
 import re
@@ -15,6 +15,10 @@ import tables
 
 import cmap.util.progress as update
 import cmap.io.plategrp as grp
+import cmap.io.gctx_index as gctx_index
+import cmap.io.gctx_memmap as gctx_memmap
+import cmap.io.gctx_rechunk as gctx_rechunk
+import cmap.io.metaquery as metaquery
 import pandas as pd
 
 class GCT(object):
@@ -23,9 +27,10 @@ class GCT(object):
     method of this class will handle reading of either .gct or .gctx files.
     Once the read method is called,  The gct matrix data can be found in the
     matrix attribute of the object.  Meta data can be found in the _meta
-    attribute (an in memory sqlite database) and accessed through utility
-    class methods or directly through sqlite3 methods. Note that this class
-    requires numpy for matrix operations and pytables for .gctx processing.
+    attribute (a dictionary holding a pandas DataFrame of columnar 'row' and
+    'col' meta data) and accessed through utility class methods. Note that
+    this class requires numpy for matrix operations and pytables for .gctx
+    processing.
 
     example usage:
     import cmap.io.gct as gct
@@ -41,8 +46,8 @@ class GCT(object):
         self.src = src
         self.version = ''
         self.matrix = ''
-        self._meta = sqlite3.connect(':memory:')
-        self._meta.text_factory = str
+        self._meta = {}
+        self._meta_indexes = {}
         self._gctx_file = ''
 
         self.matrix_node = ''
@@ -51,12 +56,50 @@ class GCT(object):
         self.column_data = ''
         self.row_data = ''
         self.frame = None
+        self._gctx_indexes = {}
+        self._matrix_memmaps = {}
+        self._companions = {}
+        self._companion_files = {}
+        self._session = False
 
         if read:
             self.read(verbose=verbose,cid=cid,rid=rid,
             col_inds=col_inds, row_inds=row_inds, matrix_only=matrix_only,
             frame=frame)
 
+    @classmethod
+    def open(cls,src):
+        '''
+        opens the gctx file at src and returns a GCT object that keeps the
+        HDF5 handle and its node references until close is called, so that
+        repeated reads pay the cost of opening the file only once. Intended
+        to be used as a context manager:
+
+        with GCT.open('path_to_gctx_file') as GCTObject:
+            GCTObject.read_gctx_matrix(cid=cid_list, rid=rid_list)
+        '''
+        gct_object = cls(src)
+        gct_object._open_gctx(src)
+        gct_object._session = True
+        return gct_object
+
+    def close(self):
+        '''
+        closes the gctx file held open by GCT.open
+        '''
+        if self._session:
+            self._session = False
+            self._close_gctx()
+            for companion_file in self._companion_files.values():
+                companion_file.close()
+            self._companion_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __repr__(self):
         return 'GCT(src=%r)' % (self.src,)
 
@@ -66,104 +109,107 @@ class GCT(object):
                           'matrix: numpy.ndarray of size ' + str(self.matrix.shape),
                           '_meta: ' + str(type(self._meta))])
 
-    def _add_table_to_meta_db(self,table_name,col_names):
+    def _set_meta_table(self,table_name,headers,columns):
         '''
-        constructs an in memory sqlite database for storage of row or column metadata
+        stores the row or column metadata as a table with one array per header
         '''
+        self._meta[table_name] = pd.DataFrame(dict(zip(headers, columns)),
+                                              columns=headers)
+        self._meta_indexes.pop(table_name, None)
 
-        #translate table_name and table_list into a valid SQL command
-        command_string = 'create table ' + table_name + '('
-        for i in range(len(col_names)):
-            command_string += '%s text'
-            if not i == len(col_names)-1:
-                command_string += ', '
-        command_string += ')'
-        command_string = command_string % tuple(col_names)
-
-        #connect to the db and create the table
-        c = self._meta.cursor()
-        c.execute(command_string)
-        self._meta.commit()
-        c.close()
-
-    def _add_row_to_meta_table(self,table_name,data_array):
+    def _get_meta_table(self,table_name):
         '''
-        adds the specified array of data to the desired metadata table
+        returns the row or column metadata table, which is empty until read
         '''
+        return self._meta.get(table_name, pd.DataFrame())
 
-
-        #translate table_name and table_list into a valid SQL command
-        command_string = "insert into %s values (" % (table_name,)
-        for i in range(len(data_array)):
-            command_string += "%s"
-            if not i == len(data_array)-1:
-                command_string += ", "
-        command_string += ")"
-        for i,item in enumerate(data_array):
-            if isinstance(item,str):
-                data_array[i] = '"' + str(item) + '"'
-
-        command_string = command_string % tuple(data_array)
-
-        #connect to the db and add data_array to the table
-        c = self._meta.cursor()
-        c.execute(command_string)
-        self._meta.commit()
-        c.close()
-
-    def _read_gct(self,src,verbose=True,frame=True):
+    def _read_gct(self,src,verbose=True,frame=True,chunk_size=10000,callback=None):
         '''
-        reads tab delimited gct file
+        reads tab delimited gct file. The header and column meta data are
+        parsed line by line and the rows are then parsed chunk_size at a time
+        by the vectorized pandas reader. If callback is given it is called as
+        callback(start, row_meta, values) for each chunk, with start the index
+        of the chunk's first row, row_meta a DataFrame of the chunk's row meta
+        data and values a numpy array of its data; the matrix and the row meta
+        data are then not kept, so files larger than memory can be streamed
         '''
         #open a update indicator
         if verbose:
             progress_bar = update.DeterminateProgressBar('GCT_READER')
 
         #open the file
-        f = open(src,'rb')
-        reader = csv.reader(f, delimiter='\t')
+        f = open(src,'r')
         self.src = src
 
-        #read the gct file header information and build the empty self.matrix
-        #array for later use
-        self.version = reader.next()[0]
-        dims = reader.next()
-        self.matrix = numpy.ndarray([int(dims[0]), int(dims[1])])
-
-        #parse the first line to get sample names and row meta_data headers
-        titles = reader.next()
-        cid = titles[int(dims[2])+1:]
-        row_meta_headers = titles[:int(dims[2])+1]
-        row_meta_headers.insert(0,'ind')
-        self._add_table_to_meta_db('row', row_meta_headers)
+        #read the gct file header information. Version 1.2 files have no
+        #meta data dimensions, only a single Description column
+        self.version = f.readline().rstrip('\r\n').split('\t')[0]
+        dims = [int(x) for x in f.readline().rstrip('\r\n').split('\t') if x]
+        if len(dims) == 2:
+            dims += [1, 0]
+        n_rows, n_cols, n_rdesc, n_cdesc = dims[:4]
+        n_meta = n_rdesc + 1
+
+        #parse the first line to get sample names and row meta_data headers.
+        #The first column holds the row ids, headed Name in version 1.2 files
+        titles = f.readline().rstrip('\r\n').split('\t')
+        cid = titles[n_meta:]
+        row_meta_headers = ['id'] + titles[1:n_meta]
 
         #parse the _meta data for the columns
-        col_meta_array = []
-        for ii,c in enumerate(cid):
-            col_meta_array.append([ii,c])
-        current_row = 0
         col_meta_headers = ['ind','id']
-        while current_row < int(dims[3]):
-            tmp_row = reader.next()
+        col_meta_columns = [range(len(cid)), cid]
+        for current_row in range(n_cdesc):
+            tmp_row = f.readline().rstrip('\r\n').split('\t')
             col_meta_headers.append(tmp_row[0])
-            for ii,item in enumerate(tmp_row[int(dims[2])+1:]):
-                col_meta_array[ii].append(item)
-            current_row += 1
-        self._add_table_to_meta_db('col', col_meta_headers)
-        for item in col_meta_array:
-            self._add_row_to_meta_table('col', item)
-
-        #parse the meta_data for the rows and store the data matrix
-        for ii,row in enumerate(reader):
-            row_meta_tmp = row[:int(dims[2])+1]
-            row_meta_tmp.insert(0,ii)
-            self._add_row_to_meta_table('row', row_meta_tmp)
-            self.matrix[ii] = row[int(dims[2])+1:]
+            col_meta_columns.append(tmp_row[n_meta:])
+        self._set_meta_table('col', col_meta_headers, col_meta_columns)
+
+        #parse the rows in chunks. Row meta data is kept as text while the
+        #data columns are parsed as floats with the usual missing value markers
+        data_columns = range(n_meta, n_meta + n_cols)
+        na_values = dict((column, ['', 'NA', 'NaN', 'nan', 'NULL', 'null', '#N/A'])
+                         for column in data_columns)
+        dtypes = dict((column, str) for column in range(n_meta))
+        dtypes.update((column, numpy.float64) for column in data_columns)
+        reader = pd.read_csv(f, sep='\t', header=None, names=range(n_meta + n_cols),
+                             dtype=dtypes, na_values=na_values,
+                             keep_default_na=False, chunksize=chunk_size)
+
+        if callback is None:
+            self.matrix = numpy.empty([n_rows, n_cols])
+        row_meta_chunks = []
+        start = 0
+        for chunk in reader:
+            stop = start + len(chunk)
+            row_meta = chunk.iloc[:, :n_meta].copy()
+            row_meta.columns = row_meta_headers
+            row_meta.insert(0, 'ind', numpy.arange(start, stop))
+            values = chunk.iloc[:, n_meta:].values
+            if callback is None:
+                self.matrix[start:stop] = values
+                row_meta_chunks.append(row_meta)
+            else:
+                callback(start, row_meta, values)
+            start = stop
             if verbose:
-                progress_bar.update('reading gct file: ', ii, int(dims[0]))
+                progress_bar.update('reading gct file: ', start, n_rows)
+        f.close()
+        if start != n_rows:
+            raise GCTException('%s has %d data rows but its header declares %d'
+                               % (src, start, n_rows))
 
         if verbose:
             progress_bar.clear()
+        if callback is not None:
+            return
+
+        headers = ['ind'] + row_meta_headers
+        if row_meta_chunks:
+            rows = pd.concat(row_meta_chunks, ignore_index=True)
+            self._set_meta_table('row', headers, [rows[x].values for x in headers])
+        else:
+            self._set_meta_table('row', headers, [[] for x in headers])
 
         #populate a data frame
         if frame:
@@ -175,6 +221,12 @@ class GCT(object):
         '''
         opens the target gctx file
         '''
+        #a session opened by GCT.open keeps its file and node references
+        if self._session:
+            if src != self.src:
+                raise GCTException('session is open on %s, not %s' % (self.src, src))
+            return
+
         #set self.src and self.version
         self.src = src
         self._gctx_file = tables.openFile(src,'r')
@@ -189,9 +241,10 @@ class GCT(object):
 
     def _close_gctx(self):
         '''
-        close the open gctx file
+        close the open gctx file, unless it is held open by GCT.open
         '''
-        self._gctx_file.close()
+        if not self._session:
+            self._gctx_file.close()
 
 
     def _read_gctx(self,src,verbose=True,cid=None,rid=None,
@@ -202,14 +255,14 @@ class GCT(object):
         '''
 
         #get the appropriate column indices
-        if not col_inds:
+        if col_inds is None:
             col_inds = self.get_gctx_cid_inds(src, match_list=cid)
 
         #read the column meta data
         self.read_gctx_col_meta(src, col_inds, verbose=verbose)
 
         #get the appropriate row indices
-        if not row_inds:
+        if row_inds is None:
             row_inds = self.get_gctx_rid_inds(src, match_list=rid)
 
         #read the row meta data
@@ -237,6 +290,16 @@ class GCT(object):
         except ValueError:
             return False
 
+    def _get_gctx_index(self,src,axis):
+        '''
+        returns the persistent id to index lookup for the 'COL' or 'ROW' axis
+        of the gctx file at src, loading it at most once per GCT object
+        '''
+        key = (src, axis)
+        if key not in self._gctx_indexes:
+            self._gctx_indexes[key] = gctx_index.GCTXIndex(src, axis)
+        return self._gctx_indexes[key]
+
     def get_gctx_cid_inds(self,src,match_list=None):
         '''
         finds all indices of cid entries that match any of the strings given in match_list
@@ -245,22 +308,16 @@ class GCT(object):
         if type(match_list) == str:
             match_list = [match_list]
 
-        #open the gctx file
-        self._open_gctx(src)
-
+        #look up the cids in the sidecar index of the gctx file
+        index = self._get_gctx_index(src, 'COL')
         if match_list == None:
-            matches = range(len(self.column_id_node))
+            matches = range(len(index))
         else:
-            #find all of the matching cids
-            cid = [x.rstrip() for x in self.column_id_node.read()]
+            matches, missings = index.get_inds(match_list)
             # check that all the items to match are in the list of cid's
-            missings = set(match_list) - set(cid)
             if missings:
                 raise Exception("The following items in the match list did not have matching cids:\n{0}".format('\n'.join(missings)))
-            # if we're good, make a cid index dictionary and return the entries we want
-            cid_idx = dict(zip(cid, range(len(cid))))
-            matches = [cid_idx[x] for x in match_list]
-        self._close_gctx()
+            matches = matches.tolist()
         return matches
 
     def get_gctx_cid(self,src=None,match_list=None):
@@ -301,22 +358,16 @@ class GCT(object):
         if type(match_list) == str:
             match_list = [match_list]
 
-        #open the gctx file
-        self._open_gctx(src)
-
+        #look up the rids in the sidecar index of the gctx file
+        index = self._get_gctx_index(src, 'ROW')
         if match_list == None:
-            matches = range(len(self.row_id_node))
+            matches = range(len(index))
         else:
-            #find all of the matching rids
-            rid = [x.rstrip() for x in self.row_id_node.read()]
+            matches, missings = index.get_inds(match_list)
             # check that all the items to match are in the list of rid's
-            missings = set(match_list) - set(rid)
             if missings:
                 raise Exception("The following items in the match list did not have matching rids:\n{0}".format('\n'.join(missings)))
-            # if we're good, make the dictionary and return the matches
-            rid_idx = dict(zip(rid, range(len(rid))))
-            matches = [rid_idx[x] for x in match_list]
-        self._close_gctx()
+            matches = matches.tolist()
         return matches
 
     def get_gctx_rid(self,src=None,match_list=None):
@@ -345,11 +396,181 @@ class GCT(object):
         matches = [x.rstrip() for x in matches]
         return matches
 
+    def _read_gctx_chunks(self,col_inds,row_inds,out=None,max_read_bytes=2**28,
+                          node=None):
+        '''
+        read the matrix entries at col_inds by row_inds (signature by probe,
+        in the requested order) from the open gctx file, reading each HDF5
+        chunk of the matrix node at most once. The requested column indices
+        are sorted and grouped by chunk, runs of adjacent chunks are coalesced
+        into single reads of at most max_read_bytes, and each read is
+        scattered into out, a preallocated signature by probe array (or view)
+        that is allocated if not given. Statistics on the reads are stored in
+        self.read_stats. node defaults to the matrix node of the open file.
+        '''
+        if node is None:
+            node = self.matrix_node
+        col_inds = numpy.asarray(col_inds, dtype=numpy.int64)
+        row_inds = numpy.asarray(row_inds, dtype=numpy.int64)
+        ncols, nrows = node.shape
+        itemsize = node.atom.itemsize
+        if out is None:
+            out = numpy.empty([len(col_inds), len(row_inds)], dtype=node.atom.dtype)
+        if len(col_inds) == 0 or len(row_inds) == 0:
+            self.read_stats = {'reads': 0, 'chunks_read': 0, 'bytes_read': 0,
+                               'bytes_requested': 0}
+            return out
+
+        #a contiguous dataset is read as if each of its rows were a chunk
+        chunkshape = node.chunkshape
+        if chunkshape is None:
+            chunkshape = (1, nrows)
+        chunk_ncols, chunk_nrows = chunkshape
+
+        #read the chunk aligned span of requested rows
+        row_start = (row_inds.min() // chunk_nrows) * chunk_nrows
+        row_stop = min((row_inds.max() // chunk_nrows + 1) * chunk_nrows, nrows)
+        local_row_inds = row_inds - row_start
+        n_row_chunks = int((row_stop - row_start + chunk_nrows - 1) // chunk_nrows)
+        chunk_bytes = chunk_ncols * (row_stop - row_start) * itemsize
+
+        #sort the requested columns, keeping track of where each one goes
+        unique_cols, inverse = numpy.unique(col_inds, return_inverse=True)
+        sorter = numpy.argsort(inverse, kind='mergesort')
+        sorted_inverse = inverse[sorter]
+        col_chunks = unique_cols // chunk_ncols
+
+        #group adjacent chunks into runs no larger than max_read_bytes
+        max_run = max(1, max_read_bytes // chunk_bytes)
+        chunk_ids = numpy.unique(col_chunks)
+        runs = [[chunk_ids[0], chunk_ids[0]]]
+        for chunk_id in chunk_ids[1:]:
+            run = runs[-1]
+            if chunk_id == run[1] + 1 and chunk_id - run[0] < max_run:
+                run[1] = chunk_id
+            else:
+                runs.append([chunk_id, chunk_id])
+
+        read_stats = {'reads': 0, 'chunks_read': 0, 'bytes_read': 0,
+                      'bytes_requested': len(col_inds) * len(row_inds) * itemsize}
+        for first_chunk, last_chunk in runs:
+            col_start = first_chunk * chunk_ncols
+            col_stop = min((last_chunk + 1) * chunk_ncols, ncols)
+            block = node[col_start:col_stop, row_start:row_stop]
+            read_stats['reads'] += 1
+            read_stats['chunks_read'] += int(last_chunk - first_chunk + 1) * n_row_chunks
+            read_stats['bytes_read'] += block.nbytes
+
+            #scatter the block to every requested position of its columns
+            first, last = numpy.searchsorted(col_chunks, [first_chunk, last_chunk + 1])
+            lo, hi = numpy.searchsorted(sorted_inverse, [first, last])
+            targets = sorter[lo:hi]
+            block_cols = unique_cols[inverse[targets]] - col_start
+            out[targets] = block[block_cols][:, local_row_inds]
+        self.read_stats = read_stats
+        return out
+
+    def _read_gctx_rows(self,col_inds,row_inds,out,verbose=True):
+        '''
+        fill out, a signature by probe array (or view), by iterating over the
+        rows of the matrix node between the first and last of col_inds
+        '''
+        #map each stored row to the positions in out that request it
+        positions = {}
+        for position, col_ind in enumerate(col_inds):
+            positions.setdefault(col_ind, []).append(position)
+        col_ind_min = min(positions)
+        col_ind_max = max(positions)
+
+        # set up the progress indicator, which is updated each time we reach
+        # 1/50th more of the rows
+        if verbose:
+            progress_bar = update.DeterminateProgressBar('GCTX_READER')
+        p_max = col_ind_max + 1 - col_ind_min
+        p_mod = max(1, p_max // 50)
+        for i,row in enumerate(self.matrix_node.iterrows(start=col_ind_min,stop=col_ind_max+1)):
+            for position in positions.get(col_ind_min + i, ()):
+                out[position] = numpy.take(row,row_inds)
+            if verbose and (i + 1) % p_mod == 0:
+                progress_bar.update("reading matrix data ({0},{1})".format(len(row_inds),len(col_inds)),i + 1,p_max)
+
+    def get_matrix_memmap(self,src=None):
+        '''
+        returns a read-only numpy.memmap view (signature by probe) of the
+        matrix of the gctx file at src, or None if the matrix is not stored
+        contiguously or h5py is not available. Slicing the view only reads
+        the pages it touches
+        '''
+        if not src:
+            src = self.src
+        if src not in self._matrix_memmaps:
+            self._matrix_memmaps[src] = gctx_memmap.open_matrix_memmap(src)
+        return self._matrix_memmaps[src]
+
+    def get_companion(self,src=None):
+        '''
+        returns the path of the current probe-major companion of the gctx file
+        at src written by cmap.io.gctx_rechunk, or None if there is none
+        '''
+        if not src:
+            src = self.src
+        if src not in self._companions:
+            self._companions[src] = gctx_rechunk.find_companion(src)
+        return self._companions[src]
+
+    def _read_gctx_companion(self,companion,col_inds,row_inds,out):
+        '''
+        fill out, a signature by probe array (or view), from the matrix node of
+        the probe-major companion file, which stays open during a session
+        '''
+        companion_file = self._companion_files.get(companion)
+        if companion_file is None:
+            companion_file = tables.openFile(companion,'r')
+        try:
+            node = companion_file.getNode("/0/DATA/0", "matrix")
+            #read each run of adjacent probe chunks separately, so that
+            #scattered probes do not read the chunks between them
+            chunk_nrows = node.chunkshape[1]
+            row_chunks = row_inds // chunk_nrows
+            order = numpy.argsort(row_chunks, kind='mergesort')
+            breaks = numpy.flatnonzero(numpy.diff(row_chunks[order]) > 1) + 1
+            read_stats = {}
+            for positions in numpy.split(order, breaks):
+                out[:, positions] = self._read_gctx_chunks(col_inds, row_inds[positions],
+                                                           node=node)
+                for key, value in self.read_stats.items():
+                    read_stats[key] = read_stats.get(key, 0) + value
+            self.read_stats = read_stats
+        finally:
+            if self._session:
+                self._companion_files[companion] = companion_file
+            else:
+                companion_file.close()
+
     def read_gctx_matrix(self,src=None,cid=None,rid=None,col_inds=None,
                          row_inds=None, verbose=True, convert_to_double=False,
-                         row_optimized=False):
-        '''
-        read just the matrix data from a gctx file
+                         row_optimized=False, memmap=False, dtype=None,
+                         order='C', probe_major=None):
+        '''
+        read just the matrix data from a gctx file into self.matrix, a probe by
+        signature array ordered as row_inds and col_inds. The array is
+        allocated once, with the given dtype (float32 by default or float64
+        if convert_to_double) and memory layout order ('C' or 'F'), and is
+        filled directly from disk. col_inds or row_inds of None select every
+        column or row (or those matching cid or rid), while empty ones, such
+        as the result of a query matching nothing, give an empty matrix.
+
+        By default the matrix is read with _read_gctx_chunks, which reads each
+        HDF5 chunk at most once and reports the bytes and chunks read in
+        self.read_stats. If row_optimized is True, the stored rows between the
+        first and last of col_inds are iterated over instead. If memmap is
+        True and the matrix is stored contiguously, it is sliced from the view
+        returned by get_matrix_memmap instead of through PyTables.
+
+        If a probe-major companion written by cmap.io.gctx_rechunk exists and
+        is current, reads that select a larger fraction of the signatures than
+        of the probes are made from it instead. probe_major=True requires the
+        companion and probe_major=False never uses it
         '''
         #open an update indicator
         if verbose:
@@ -360,75 +581,58 @@ class GCT(object):
             src = self.src
 
         #get the appropriate column indices
-        if not col_inds:
+        if col_inds is None:
             col_inds = self.get_gctx_cid_inds(src, match_list=cid)
 
         #get the appropriate row indices
-        if not row_inds:
+        if row_inds is None:
             row_inds = self.get_gctx_rid_inds(src, match_list=rid)
         #open the gctx file
         self._open_gctx(src)
 
         #set up the indices
-        if not col_inds:
+        if col_inds is None:
             col_inds = range(len(self.column_id_node))
-        if not row_inds:
+        if row_inds is None:
             row_inds = range(len(self.row_id_node))
-
-        #check if we're reading just reading the epsilon landmark genes
-        #if so, can get the matrix in one read
-        if row_inds == range(978):
-            self.matrix = self.matrix_node[col_inds, 0:978]
-        #otherwise, figure out which direction reads the fewest elements
-        # then read in that orientation
+        col_inds = numpy.asarray(col_inds, dtype=numpy.int64)
+        row_inds = numpy.asarray(row_inds, dtype=numpy.int64)
+
+        #allocate the probe by signature matrix. Its transpose is a signature
+        #by probe view matching the layout of the matrix node, which the
+        #readers fill in place
+        if dtype is None:
+            dtype = numpy.float64 if convert_to_double else numpy.float32
+        self.matrix = numpy.empty([len(row_inds), len(col_inds)], dtype=dtype, order=order)
+        matrix_t = self.matrix.transpose()
+
+        #slice a memory-mapped view of a contiguous matrix, a block of
+        #signatures at a time
+        matrix_memmap = self.get_matrix_memmap(src) if memmap else None
+        if self.matrix.size == 0:
+            #an empty selection reads nothing
+            pass
+        elif matrix_memmap is not None:
+            block_size = 1024
+            for start in range(0, len(col_inds), block_size):
+                block_inds = col_inds[start:start + block_size]
+                matrix_t[start:start + block_size] = matrix_memmap[block_inds][:, row_inds]
+        elif row_optimized:
+            self._read_gctx_rows(col_inds, row_inds, matrix_t, verbose=verbose)
         else:
             ncols, nrows = self.matrix_node.shape
-            n_bycol = nrows * len(col_inds)
-            n_byrow = ncols * len(row_inds)
-            if row_optimized:
-                # pre-allocate the matrix to be filled as we iterate over the
-                # HDF5 matrix on disk
-                self.matrix = numpy.zeros([len(col_inds),len(row_inds)],dtype=numpy.float32)
-
-                # create a set of col_inds to check membership on each row
-                # iteration
-                col_ind_set = dict(zip(col_inds,col_inds))
-
-                # dtermine the range of columns we must read
-                col_ind_min = numpy.min(col_inds)
-                col_ind_max = numpy.max(col_inds)
-
-                # set up an iterator for the progress indicator.  This will be
-                # iterated every time we read a row that is called for.  The
-                # progress will be logged every time we reach 1/50th more of the
-                # data
-                p_iter = 0;
-                p_max = len(col_inds)
-                num_rows = len(row_inds)
-                p_mod = numpy.round(p_max/50.0)
-                for i,row in enumerate(self.matrix_node.iterrows(start=col_ind_min,stop=col_ind_max+1)):
-                    if i in col_ind_set:
-                        self.matrix[p_iter,:] = numpy.take(row,row_inds)
-                        p_iter += 1
-                        if p_iter%p_mod == 0:
-                            if verbose:
-                                progress_bar.update("reading matrix data ({0},{1})".format(num_rows,p_max),p_iter,p_max)
-
+            companion = None
+            if probe_major or (probe_major is None and
+                               len(row_inds) * ncols < len(col_inds) * nrows):
+                companion = self.get_companion(src)
+                if probe_major and companion is None:
+                    self._close_gctx()
+                    raise GCTException('%s has no current probe-major companion' % (src,))
+            #read each chunk of the matrix node once, in on-disk order
+            if companion is not None:
+                self._read_gctx_companion(companion, col_inds, row_inds, matrix_t)
             else:
-                if n_bycol <= n_byrow:
-                    self.matrix = self.matrix_node[col_inds,:]
-                    self.matrix = self.matrix[:,row_inds]
-                else:
-                    self.matrix = self.matrix_node[:,row_inds]
-                    self.matrix = self.matrix[col_inds,:]
-        # make sure the data is in the right order given the col_inds and row_inds
-        self.matrix = self.matrix[col_inds.sort(),:]
-        self.matrix = self.matrix[:,row_inds.sort()]
-        self.matrix =  numpy.reshape(self.matrix,(len(col_inds),len(row_inds)))
-        self.matrix = self.matrix.transpose()
-        # convert data to double precision of called for
-        if convert_to_double:
-            self.matrix = self.matrix.astype(numpy.float)
+                self._read_gctx_chunks(col_inds, row_inds, out=matrix_t)
 
         #close the gctx file
         self._close_gctx()
@@ -437,6 +641,24 @@ class GCT(object):
         if verbose:
             progress_bar.clear()
 
+    def _read_meta_node(self,node,inds):
+        '''
+        reads the entries of a metadata node at inds with bulk HDF5 reads.
+        Large selections read the whole node, small ones read just the sorted
+        unique inds.  Trailing whitespace is stripped from strings
+        '''
+        inds = numpy.asarray(inds, dtype=numpy.int64)
+        if len(inds) == 0:
+            data = node[0:0]
+        elif len(inds) > len(node) // 10:
+            data = node.read()[inds]
+        else:
+            unique_inds, inverse = numpy.unique(inds, return_inverse=True)
+            data = node[unique_inds.tolist()][inverse]
+        if data.dtype.kind in 'SU':
+            data = numpy.char.rstrip(data)
+        return data
+
     def read_gctx_col_meta(self,src,col_inds=None, verbose=True):
         '''
         read the column meta data from the file given in src.  If col_inds is given, only
@@ -445,29 +667,22 @@ class GCT(object):
         #open an update indicator
         if verbose:
             progress_bar = update.DeterminateProgressBar('GCTX_READER')
+            progress_bar.show_message('reading column meta data')
 
         #open the gctx file
         self._open_gctx(src)
 
         #set up the indices
-        if not col_inds:
+        if col_inds is None:
             col_inds = range(len(self.column_id_node))
 
-        #read in the column meta data
+        #read in the column meta data, one field at a time
         column_headers = [x.name for x in self.column_data]
         column_headers.insert(0,'ind')
-        self._add_table_to_meta_db("col", column_headers)
-        num_rows = len(col_inds)
-        meta_data_array = numpy.empty([len(column_headers),num_rows], dtype=numpy.dtype('a400'))
-        meta_data_array[0,:] = [str(x) for x in col_inds]
-        for i,column in enumerate(self.column_data):
-            data = column[col_inds]
-            meta_data_array[i+1,:] = [str(x).rstrip() for x in data]
-        for i,col_ind in enumerate(col_inds):
-            if verbose:
-                progress_bar.update('reading column meta data', i, num_rows)
-            data_list = list(meta_data_array[:,i])
-            self._add_row_to_meta_table("col", data_list)
+        columns = [numpy.asarray(col_inds, dtype=numpy.int64)]
+        for column in self.column_data:
+            columns.append(self._read_meta_node(column, col_inds))
+        self._set_meta_table('col', column_headers, columns)
 
         #clear the update indicator
         if verbose:
@@ -484,26 +699,22 @@ class GCT(object):
         #open an update indicator
         if verbose:
             progress_bar = update.DeterminateProgressBar('GCTX_READER')
+            progress_bar.show_message('reading row meta data')
 
         #open the gctx file
         self._open_gctx(src)
 
         #set up the indices
-        if not row_inds:
+        if row_inds is None:
             row_inds = range(len(self.row_id_node))
 
-        #read in the row meta data
+        #read in the row meta data, one field at a time
         row_headers = [x.name for x in self.row_data]
         row_headers.insert(0,'ind')
-        self._add_table_to_meta_db("row", row_headers)
-        num_rows = len(row_inds)
-        for i,ind in enumerate(row_inds):
-            if verbose:
-                progress_bar.update('reading row meta data', i, num_rows)
-            data_list = [ind]
-            for column in self.row_data:
-                data_list.append(str(column[ind]).rstrip())
-            self._add_row_to_meta_table("row", data_list)
+        columns = [numpy.asarray(row_inds, dtype=numpy.int64)]
+        for column in self.row_data:
+            columns.append(self._read_meta_node(column, row_inds))
+        self._set_meta_table('row', row_headers, columns)
 
         #clear the update indicator
         if verbose:
@@ -582,14 +793,8 @@ class GCT(object):
         cdesc['ind'] = range(ncols)
         rhd = rdesc.keys()
         chd = cdesc.keys()
-        self._add_table_to_meta_db('row', rhd)
-        self._add_table_to_meta_db('col', chd)
-        for i in xrange(nrows):
-            thisrow = [str(rdesc[k][i]) for k in rhd]
-            self._add_row_to_meta_table('row', thisrow)
-        for i in xrange(ncols):
-            thisrow = [str(cdesc[k][i]) for k in chd]
-            self._add_row_to_meta_table('col', thisrow)
+        self._set_meta_table('row', rhd, [rdesc[k] for k in rhd])
+        self._set_meta_table('col', chd, [cdesc[k] for k in chd])
         self.frame = pd.DataFrame(self.matrix,
                                       index = self.get_row_meta('id'),
                                       columns = self.get_column_meta('id'))
@@ -691,197 +896,134 @@ class GCT(object):
         else:
             raise Exception('The only mode currently supported is gctx')
 
+    def _get_meta_entry(self,table_name,entry_id):
+        '''
+        return a dictionary of the _meta data for the first entry of the row or
+        column table with the given id
+        '''
+        table = self._get_meta_table(table_name)
+        position = numpy.flatnonzero(table['id'].astype(str).values == entry_id)[0]
+        return dict((header, str(table[header].iat[position])) for header in table.columns)
+
     def get_sample_meta(self,sample_name):
         '''
         return a dictionary of the _meta data for the sample specified by sample_name
         '''
-        #get the headers of the col database
-        chd = self.get_chd()
-
-        #build a dictionary of _meta data for the sample
-        sample_meta = {}
-        c = self._meta.cursor()
-        for header in chd:
-            query = "SELECT %s FROM col WHERE id=?" % (header,)
-            c.execute(query, (sample_name,))
-            sample_meta.update({header : str(c.fetchone()[0])})
-        self._meta.commit()
-        c.close()
-
-        #return the dictionary
-        return sample_meta
+        return self._get_meta_entry('col', sample_name)
 
     def get_column_meta(self,column_name):
         '''
         return a list of all meta data entries in the column specified by column_name
         '''
-        c = self._meta.cursor()
-        query = "SELECT %s FROM col" % (column_name,)
-        c.execute(query)
-        meta_list = []
-        for row in c:
-            meta_list.append(str(row[0]))
-        c.close()
-        return meta_list
+        return [str(x) for x in self._get_meta_table('col')[column_name]]
 
     def get_row_meta(self,row_name):
         '''
         return a list of all meta data entries in the column specified by row_name
         '''
-        c = self._meta.cursor()
-        query = "SELECT %s FROM row" % (row_name,)
-        c.execute(query)
-        meta_list = []
-        for row in c:
-            meta_list.append(str(row[0]))
-        c.close()
-        return meta_list
+        return [str(x) for x in self._get_meta_table('row')[row_name]]
 
     def get_probe_meta(self,sample_name):
         '''
         return a dictionary of the _meta data for the probe specified by probe_name
         '''
-        #get the headers of the row database
-        chd = self.get_rhd()
+        return self._get_meta_entry('row', sample_name)
 
-        #build a dictionary of _meta data for the sample
-        probe_meta = {}
-        c = self._meta.cursor()
-        for header in chd:
-            query = "SELECT %s FROM row WHERE id=?" % (header,)
-            c.execute(query, (sample_name,))
-            probe_meta.update({header : str(c.fetchone()[0])})
-        self._meta.commit()
-        c.close()
+    #comparison operators supported by get_inds_by_cdesc and get_inds_by_rdesc
+    _desc_ops = {'=': operator.eq, '==': operator.eq, '!=': operator.ne,
+                 '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+                 '>': operator.gt, '>=': operator.ge}
 
-        #return the dictionary
-        return probe_meta
+    def _get_inds_by_desc(self,table_name,column,desc,op='='):
+        '''
+        return the indices of the entries of a row or column table whose value
+        in column compares to desc with op.  Numeric descs are compared with
+        the column cast to numbers, as SQL CAST(column AS REAL) would
+        '''
+        table = self._get_meta_table(table_name)
+        if op not in self._desc_ops:
+            raise GCTException('unsupported comparison operator %s' % (op,))
+        if self._is_number(desc):
+            values = pd.to_numeric(table[column].astype(str), errors='coerce').fillna(0)
+            mask = self._desc_ops[op](values.values, float(desc))
+        else:
+            mask = self._desc_ops[op](table[column].astype(str).values, str(desc))
+        return [int(x) for x in table['ind'].values[mask]]
 
     def get_inds_by_cdesc(self,column,desc,op='='):
         '''
         look for all of the entries in the column _meta data matching cdesc in column and
         return their indices in an list
         '''
-        #construct the query
-        if self._is_number(desc):
-            query = "SELECT ind FROM col WHERE CAST(%s AS REAL) %s '%s'" % (column,op,desc)
-        else:
-            query = "SELECT ind FROM col WHERE %s %s '%s'" % (column,op,desc)
-
-        #query the col database and store the returned indices
-        inds = []
-        c = self._meta.cursor()
-        c.execute(query)
-        for row in c:
-            inds.append(int(row[0]))
-        c.close()
-
-        return inds
+        return self._get_inds_by_desc('col', column, desc, op)
 
     def get_inds_by_rdesc(self,column,desc,op='='):
         '''
         look for all of the entries in the row _meta data matching cdesc in column and
         return their indices in an list
         '''
-        #construct the query
-        if self._is_number(desc):
-            query = "SELECT ind FROM row WHERE CAST(%s AS REAL) %s '%s'" % (column,op,desc)
-        else:
-            query = "SELECT ind FROM row WHERE %s %s '%s'" % (column,op,desc)
-
-        #query the col database and store the returned indices
-        inds = []
-        c = self._meta.cursor()
-        c.execute(query)
-        for row in c:
-            inds.append(int(row[0]))
-        c.close()
+        return self._get_inds_by_desc('row', column, desc, op)
 
-        return inds
+    def _get_meta_index(self,table_name):
+        '''
+        returns the typed query index of the row or column table, built on
+        first use and discarded when the table is replaced
+        '''
+        if table_name not in self._meta_indexes:
+            self._meta_indexes[table_name] = metaquery.MetaIndex(self._get_meta_table(table_name))
+        return self._meta_indexes[table_name]
 
-    def get_cids(self, sorted_as_input = False):
+    def get_inds_by_cquery(self,predicate):
         '''
-        returns a list of all column ids found in the dataset
+        return a numpy array of the indices of the columns matching a compound
+        predicate built from cmap.io.metaquery.Field, for example
+        (Field('cell_id') == 'MCF7') & Field('pert_time').between(6, 24).
+        The indices can be passed directly to read_gctx_matrix as col_inds
         '''
-        #query the col database for all ids
-        inds = []
-        ids = []
-        c = self._meta.cursor()
-        c.execute("SELECT ind, id FROM col")
-        for row in c:
-            inds.append(int(row[0]))
-            ids.append(str(row[1]))
-        c.close()
+        return self._get_meta_index('col').query(predicate)
 
-        #ensure that the ids are in the proper order according to ind
-        inds_ids = zip(inds,ids)
-        inds_ids.sort()
-        ordered_ids = [item[1] for item in inds_ids]
+    def get_inds_by_rquery(self,predicate):
+        '''
+        return a numpy array of the indices of the rows matching a compound
+        predicate built from cmap.io.metaquery.Field
+        '''
+        return self._get_meta_index('row').query(predicate)
 
-        # if requested, return in order they were asked for from user
-        if sorted_as_input:
-            ordered_ids = self.get_column_meta('id')
+    def _get_ids(self,table_name,sorted_as_input=False):
+        '''
+        returns a list of all ids of the row or column table, ordered by their
+        index in the source file or, if requested, as they were asked for
+        '''
+        table = self._get_meta_table(table_name)
+        ids = table['id']
+        if not sorted_as_input:
+            order = numpy.argsort(table['ind'].astype(int).values, kind='mergesort')
+            ids = ids.iloc[order]
+        return [str(x) for x in ids]
 
-        #return the result
-        return ordered_ids
+    def get_cids(self, sorted_as_input = False):
+        '''
+        returns a list of all column ids found in the dataset
+        '''
+        return self._get_ids('col', sorted_as_input)
 
     def get_rids(self, sorted_as_input = False):
         '''
         returns a list of all row ids found in the dataset
         '''
-        #query the col database for all ids
-        inds = []
-        ids = []
-        c = self._meta.cursor()
-        c.execute("SELECT ind, id FROM row")
-        for row in c:
-            inds.append(int(row[0]))
-            ids.append(str(row[1]))
-        c.close()
-
-        #ensure that the ids are in the proper order according to ind
-        inds_ids = zip(inds,ids)
-        inds_ids.sort()
-        ordered_ids = [item[1] for item in inds_ids]
-
-        # if requested, return in order they were asked for from user
-        if sorted_as_input:
-            ordered_ids = self.get_row_meta('id')
-
-        #return the result
-        return ordered_ids
+        return self._get_ids('row', sorted_as_input)
 
     def get_rhd(self):
         '''
         returns the names of the row _meta data headers in a list
         '''
-        #query the row data base for its headers using a pragma statement
-        c = self._meta.cursor()
-        c.execute("PRAGMA table_info(row)")
-
-        #pull out all of the headers from the returned tuple
-        rhd = []
-        for header_tuple in c:
-            rhd.append(str(header_tuple[1]))
-
-        #return the header list
-        return rhd
+        return [str(x) for x in self._get_meta_table('row').columns]
 
     def get_chd(self):
         '''
         returns the names of the column _meta data headers in a list
         '''
-        #query the col data base for its headers using a pragma statement
-        c = self._meta.cursor()
-        c.execute("PRAGMA table_info(col)")
-
-        #pull out all of the headers from the returned tuple
-        chd = []
-        for header_tuple in c:
-            chd.append(str(header_tuple[1]))
-
-        #return the header list
-        return chd
+        return [str(x) for x in self._get_meta_table('col').columns]
 
     def mk_rdesc(self):
         '''
@@ -950,6 +1092,169 @@ def parse_gct_dict(file_path):
     gct_data = {'SAMPLES':samples,'PROBES':probes,'VERSION':version, "SOURCE":file_path}
     return gct_data
 
+def gct_to_gctx(src, dst, chunk_size=10000, verbose=True):
+    '''
+    converts the .gct file at src into a .gctx file at dst. Rows are parsed
+    chunk_size at a time and appended to an extendable matrix node along the
+    probe axis, so neither file needs to fit in memory
+    '''
+    gct_object = GCT(src)
+    row_meta_chunks = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        h5f = tables.openFile(dst, mode = 'w')
+        try:
+            h5f.setNodeAttr('/', 'version', 'GCTX1.0')
+            h5f.createGroup('/', '0')
+            h5f.createGroup('/0/DATA', '0', createparents = True)
+
+            # the matrix is stored signature by probe, so each chunk of
+            # probes extends its second axis
+            def append_rows(start, row_meta, values):
+                if start == 0:
+                    h5f.createEArray('/0/DATA/0', 'matrix', tables.Float32Atom(),
+                                     (values.shape[1], 0), expectedrows=chunk_size)
+                h5f.getNode('/0/DATA/0/matrix').append(values.transpose().astype(numpy.float32))
+                row_meta_chunks.append(row_meta)
+
+            gct_object._read_gct(src, verbose, frame=False, chunk_size=chunk_size,
+                                 callback=append_rows)
+            if not row_meta_chunks:
+                h5f.createEArray('/0/DATA/0', 'matrix', tables.Float32Atom(),
+                                 (len(gct_object.get_cids()), 0))
+
+            # store the annotations, except for "ind"; held internally only
+            h5f.createGroup('/0/META', 'COL', createparents = True)
+            for field in [x for x in gct_object.get_chd() if x != 'ind']:
+                h5f.createArray('/0/META/COL', field,
+                                numpy.array(gct_object.get_column_meta(field)))
+            h5f.createGroup('/0/META', 'ROW', createparents = True)
+            if row_meta_chunks:
+                rows = pd.concat(row_meta_chunks, ignore_index=True)
+                for field in [x for x in rows.columns if x != 'ind']:
+                    h5f.createArray('/0/META/ROW', field,
+                                    numpy.array([str(x) for x in rows[field]]))
+        finally:
+            h5f.close()
+
+class GCTXWriter(object):
+    '''
+    writes a .gctx file incrementally. The matrix node is an extendable,
+    chunked and compressed array of signatures by probes that grows by one
+    block of columns per call to append, so the matrix never needs to be held
+    in memory. Only the column ids and meta data are kept until close, when
+    their nodes are written.
+
+    example usage:
+    import cmap.io.gct as gct
+    with gct.GCTXWriter('consensi.gctx', rid=probes) as writer:
+        for block, cids, col_meta in blocks:
+            writer.append(block, cids, col_meta)
+    '''
+    def __init__(self, dst, rid, row_meta=None, chunkshape=None,
+                 complevel=4, complib='zlib', expected_columns=10000):
+        '''
+        dst is the path of the gctx file to create and rid the ids of its rows.
+        row_meta is an optional dict or DataFrame of row meta data fields with
+        one entry per row. chunkshape defaults to the PyTables choice for
+        expected_columns signatures
+        '''
+        self.dst = dst
+        self.rid = [str(x) for x in rid]
+        self.n_columns = 0
+        self._cid = []
+        self._col_meta = None
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self._h5f = tables.openFile(dst, mode = 'w')
+            self._h5f.setNodeAttr('/', 'version', 'GCTX1.0')
+            self._h5f.createGroup('/', '0')
+            self._h5f.createGroup('/0/DATA', '0', createparents = True)
+            filters = tables.Filters(complevel=complevel, complib=complib, shuffle=True)
+            self._matrix = self._h5f.createEArray('/0/DATA/0', 'matrix',
+                                                  tables.Float32Atom(),
+                                                  (0, len(self.rid)),
+                                                  filters=filters,
+                                                  expectedrows=expected_columns,
+                                                  chunkshape=chunkshape)
+            self._h5f.createGroup('/0/META', 'ROW', createparents = True)
+            self._h5f.createArray('/0/META/ROW', 'id', numpy.array(self.rid, dtype=str))
+            for field, values in _meta_fields(row_meta, len(self.rid)):
+                self._h5f.createArray('/0/META/ROW', field, _meta_array(values))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, block, cid=None, col_meta=None):
+        '''
+        appends a block of columns (probes by signatures, the layout of
+        GCT.matrix) with their ids and an optional dict or DataFrame of column
+        meta data. If block is a DataFrame its columns are used as ids when
+        cid is not given; otherwise cid is required. Every block must provide
+        the same meta data fields
+        '''
+        if cid is None:
+            if not isinstance(block, pd.DataFrame):
+                raise ValueError('cid is required when block is not a DataFrame')
+            cid = block.columns
+        block = numpy.asarray(block)
+        if block.shape[0] != len(self.rid) or block.shape[1] != len(cid):
+            raise GCTException('block of shape %s does not match %d rows and %d ids'
+                               % (block.shape, len(self.rid), len(cid)))
+        fields = _meta_fields(col_meta, len(cid))
+        if self._col_meta is None:
+            self._col_meta = dict((field, []) for field, values in fields)
+        if set(field for field, values in fields) != set(self._col_meta):
+            raise GCTException('column meta data fields differ from earlier blocks')
+        for field, values in fields:
+            self._col_meta[field].extend(values)
+        self._cid.extend(str(x) for x in cid)
+        self._matrix.append(block.transpose().astype(numpy.float32))
+        self.n_columns += block.shape[1]
+
+    def close(self):
+        '''
+        writes the column id and meta data nodes and closes the file
+        '''
+        if self._h5f is None:
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self._h5f.createGroup('/0/META', 'COL', createparents = True)
+            self._h5f.createArray('/0/META/COL', 'id', numpy.array(self._cid, dtype=str))
+            for field, values in sorted((self._col_meta or {}).items()):
+                self._h5f.createArray('/0/META/COL', field, _meta_array(values))
+        self._h5f.close()
+        self._h5f = None
+
+def _meta_fields(meta, length):
+    '''
+    returns (field, values) pairs of a dict or DataFrame of meta data, except
+    for id and ind, checking that each field has length entries
+    '''
+    if meta is None:
+        return []
+    fields = [(str(field), list(meta[field])) for field in meta
+              if field not in ('id', 'ind')]
+    for field, values in fields:
+        if len(values) != length:
+            raise GCTException('meta data field %s has %d entries, expected %d'
+                               % (field, len(values), length))
+    return fields
+
+def _meta_array(values):
+    '''
+    returns an array of meta data values for storage, numeric if all the
+    values are numbers and text otherwise
+    '''
+    values = numpy.array(values)
+    if values.dtype.kind not in 'biuf':
+        values = numpy.array([str(x) for x in values])
+    return values
+
 if __name__ == '__main__':
     os.chdir('../../unittest_resources')
     gct_data = parse_gct_dict('gct_v13.gct')
@@ -0,0 +1,134 @@
+'''
+persistent id to index lookup for the column and row ids of .gctx files
+
+The ids of a gctx axis are read once, stripped, sorted and saved next to the
+gctx file as a pair of .npy sidecars holding the sorted ids and their
+indices. Later opens memory-map the sidecars and look ids up with a binary
+search, so no full scan of /0/META/COL/id or /0/META/ROW/id is needed.
+Sidecars record the size and modification time of their gctx file and are
+rebuilt when either changes.
+'''
+import json
+import os
+import tempfile
+import warnings
+
+import numpy
+import tables
+
+class GCTXIndex(object):
+    '''
+    sorted id to index lookup for one axis ('COL' or 'ROW') of a gctx file.
+    If index_dir is given the sidecar is stored there rather than next to the
+    gctx file. If the sidecar cannot be written the index is kept in memory.
+
+    example usage:
+    import cmap.io.gctx_index as gctx_index
+    index = gctx_index.GCTXIndex('modzs.gctx', 'COL')
+    inds, missing = index.get_inds(['CPC006_A549_6H:BRD-U88459701-000-01-8:10'])
+    '''
+    def __init__(self, src, axis='COL', index_dir=None):
+        self.src = src
+        self.axis = axis
+        if index_dir is None:
+            index_dir = os.path.dirname(os.path.abspath(src))
+        name = '{0}.{1}idx'.format(os.path.basename(src), axis.lower())
+        self.ids_path = os.path.join(index_dir, name + '.ids.npy')
+        self.inds_path = os.path.join(index_dir, name + '.inds.npy')
+        self.stamp_path = os.path.join(index_dir, name + '.json')
+
+        if self._is_current():
+            self.ids = numpy.load(self.ids_path, mmap_mode='r')
+            self.inds = numpy.load(self.inds_path, mmap_mode='r')
+        else:
+            self._build()
+            self._save()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _get_stamp(self):
+        '''
+        return the size and modification time of the gctx file
+        '''
+        stat = os.stat(self.src)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def _is_current(self):
+        '''
+        determine whether a sidecar exists and matches the gctx file
+        '''
+        paths = [self.ids_path, self.inds_path, self.stamp_path]
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        with open(self.stamp_path) as read_file:
+            stamp = json.load(read_file)
+        return stamp == self._get_stamp()
+
+    def _build(self):
+        '''
+        read, strip and sort the ids of the gctx axis
+        '''
+        gctx_file = tables.openFile(self.src, 'r')
+        try:
+            ids = gctx_file.getNode('/0/META/{0}'.format(self.axis), 'id').read()
+        finally:
+            gctx_file.close()
+        ids = numpy.char.rstrip(ids)
+        # a stable sort keeps duplicate ids in file order
+        self.inds = numpy.argsort(ids, kind='mergesort')
+        self.ids = ids[self.inds]
+
+    def _save(self):
+        '''
+        write the sidecars and their stamp, warning if the directory is not
+        writable. Each file is renamed into place once complete and the stamp
+        is written last, so an interrupted or concurrent build never leaves a
+        current stamp over partial sidecars
+        '''
+        stamp = json.dumps(self._get_stamp()).encode('utf-8')
+        try:
+            _write_atomic(self.ids_path, lambda write_file: numpy.save(write_file, self.ids))
+            _write_atomic(self.inds_path, lambda write_file: numpy.save(write_file, self.inds))
+            _write_atomic(self.stamp_path, lambda write_file: write_file.write(stamp))
+        except (IOError, OSError) as error:
+            warnings.warn('could not write gctx index {0}: {1}'.format(self.ids_path, error))
+
+    def get_inds(self, match_list):
+        '''
+        return a numpy array with the index of each id in match_list and a list
+        of the ids that were not found. As with a dict built from the ids, the
+        last of any duplicated ids is returned.
+        '''
+        match_list = list(match_list)
+        ids = self.ids
+        matches = numpy.asarray(match_list)
+        if matches.dtype.kind == 'U':
+            matches = numpy.char.encode(matches, 'utf-8')
+        if not len(matches):
+            return numpy.empty(0, dtype=numpy.int64), []
+        if not len(ids):
+            return numpy.empty(0, dtype=numpy.int64), match_list
+        # ids longer than the stored width would be truncated by the search
+        fits = numpy.char.str_len(matches) <= ids.dtype.itemsize
+        matches = matches.astype(ids.dtype)
+        positions = numpy.searchsorted(ids, matches, side='right') - 1
+        found = fits & (positions >= 0)
+        found[found] = ids[positions[found]] == matches[found]
+        missing = [match_list[i] for i in numpy.flatnonzero(~found)]
+        return numpy.asarray(self.inds[positions], dtype=numpy.int64), missing
+
+def _write_atomic(path, write):
+    '''
+    call write with a binary file object for a temporary file in the
+    directory of path, then rename the temporary file to path
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as write_file:
+            write(write_file)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
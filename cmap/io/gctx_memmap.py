@@ -0,0 +1,33 @@
+'''
+zero-copy access to the matrix of .gctx files stored contiguously
+
+When /0/DATA/0/matrix is stored contiguously (not chunked, hence also not
+compressed) its values are a single block at a fixed offset in the file, which
+can be memory-mapped directly. Reading a slice then only touches the pages
+it covers. PyTables does not expose dataset offsets, so h5py is used to find
+the offset; it is an optional dependency.
+'''
+import numpy
+
+def open_matrix_memmap(src, node='/0/DATA/0/matrix'):
+    '''
+    return a read-only numpy.memmap of the matrix node of the gctx file at
+    src, with the node's shape and dtype (signature by probe), or None if the
+    node is chunked, has no data allocated, or h5py is not installed
+    '''
+    try:
+        import h5py
+    except ImportError:
+        return None
+    h5_file = h5py.File(src, 'r')
+    try:
+        dataset = h5_file[node]
+        if dataset.chunks is not None:
+            return None
+        offset = dataset.id.get_offset()
+        if offset is None:
+            return None
+        dtype, shape = dataset.dtype, dataset.shape
+    finally:
+        h5_file.close()
+    return numpy.memmap(src, mode='r', dtype=dtype, offset=offset, shape=shape)
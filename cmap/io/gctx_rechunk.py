@@ -0,0 +1,118 @@
+'''
+probe-major companion copies of .gctx files
+
+The matrix of a gctx file is stored signature by probe, usually in chunks
+spanning many probes, so reading one probe across all signatures reads the
+whole file. A companion file keeps the same logical layout and meta data but
+stores the matrix in tall, thin chunks (many signatures by few probes), so
+that probe-centric reads only touch the chunks of the requested probes.
+
+The companion of modzs.gctx is modzs.probe-major.gctx. It records the size
+and modification time of its source and is ignored once either changes.
+GCT.read_gctx_matrix uses a current companion automatically for reads that
+select a larger fraction of the signatures than of the probes.
+
+example usage:
+python -m cmap.io.gctx_rechunk modzs.gctx
+'''
+import argparse
+import os
+import warnings
+
+import tables
+
+def companion_path(src):
+    '''
+    return the path of the probe-major companion of the gctx file at src
+    '''
+    return os.path.splitext(src)[0] + '.probe-major.gctx'
+
+def _get_stamp(src):
+    '''
+    return the size and modification time of the gctx file at src
+    '''
+    stat = os.stat(src)
+    return stat.st_size, stat.st_mtime
+
+def find_companion(src):
+    '''
+    return the path of the probe-major companion of the gctx file at src, or
+    None if there is no companion or it was built from a different version
+    of src
+    '''
+    path = companion_path(src)
+    if not os.path.exists(path):
+        return None
+    gctx_file = tables.openFile(path, 'r')
+    try:
+        attrs = gctx_file.root._v_attrs
+        if 'source_size' not in attrs or 'source_mtime' not in attrs:
+            return None
+        stamp = (int(attrs.source_size), float(attrs.source_mtime))
+    finally:
+        gctx_file.close()
+    return path if stamp == _get_stamp(src) else None
+
+def write_probe_major(src, dst=None, chunkshape=(4096, 16),
+                      max_block_bytes=2**28, complevel=0, complib='zlib'):
+    '''
+    write a copy of the gctx file at src whose matrix is stored in chunks of
+    chunkshape (signatures, probes), by default to its companion path. The
+    matrix is copied a block of whole chunk rows at a time, so at most about
+    max_block_bytes of it are held in memory. The file is written under a
+    temporary name and renamed when complete. Returns the path written
+    '''
+    if dst is None:
+        dst = companion_path(src)
+    tmp_dst = dst + '.tmp'
+    src_size, src_mtime = _get_stamp(src)
+
+    src_file = tables.openFile(src, 'r')
+    dst_file = tables.openFile(tmp_dst, 'w')
+    try:
+        src_matrix = src_file.getNode('/0/DATA/0/matrix')
+        ncols, nrows = src_matrix.shape
+        chunkshape = (max(1, min(chunkshape[0], ncols)),
+                      max(1, min(chunkshape[1], nrows)))
+
+        # the natural naming warning for group '0' is expected for gctx files
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            dst_file.createGroup('/0/DATA', '0', createparents=True)
+        filters = tables.Filters(complevel=complevel, complib=complib,
+                                 shuffle=complevel > 0)
+        dst_matrix = dst_file.createCArray('/0/DATA/0', 'matrix',
+                                           src_matrix.atom, src_matrix.shape,
+                                           filters=filters, chunkshape=chunkshape)
+
+        #copy whole rows of destination chunks so each chunk is written once
+        row_bytes = nrows * src_matrix.atom.itemsize
+        block_size = max(1, max_block_bytes // (row_bytes * chunkshape[0])) * chunkshape[0]
+        for start in range(0, ncols, block_size):
+            stop = min(start + block_size, ncols)
+            dst_matrix[start:stop] = src_matrix[start:stop]
+
+        src_file.copyNode('/0/META', newparent=dst_file.getNode('/0'),
+                          recursive=True)
+        attrs = dst_file.root._v_attrs
+        if 'version' in src_file.root._v_attrs:
+            attrs.version = src_file.root._v_attrs.version
+        attrs.source_size = src_size
+        attrs.source_mtime = src_mtime
+    finally:
+        dst_file.close()
+        src_file.close()
+    os.rename(tmp_dst, dst)
+    return dst
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write a probe-major companion of a gctx file')
+    parser.add_argument('src', help='gctx file to rechunk')
+    parser.add_argument('--dst', help='output path, by default the companion path of src')
+    parser.add_argument('--chunk-signatures', type=int, default=4096)
+    parser.add_argument('--chunk-probes', type=int, default=16)
+    parser.add_argument('--complevel', type=int, default=0)
+    args = parser.parse_args()
+    write_probe_major(args.src, args.dst,
+                      chunkshape=(args.chunk_signatures, args.chunk_probes),
+                      complevel=args.complevel)
@@ -0,0 +1,183 @@
+'''
+compound predicate queries over GCT row and column meta data
+
+Predicates are built from Field objects and combined with & (and), | (or)
+and ~ (not). They are evaluated against a MetaIndex, which types each meta
+data field once: numeric fields become numeric arrays and text fields become
+sorted categorical codes, so equality, membership and range tests are
+vectorized comparisons of integers or numbers.
+
+example usage:
+from cmap.io.metaquery import Field
+query = ((Field('cell_id') == 'MCF7') & (Field('pert_time') == 24) &
+         Field('pert_type').isin(['trt_cp']) & (Field('is_gold') == 1))
+col_inds = GCTObject.get_inds_by_cquery(query)
+GCTObject.read_gctx_matrix(col_inds=col_inds)
+'''
+import operator
+
+import numpy
+import pandas as pd
+
+#comparison operators of Field predicates
+_ops = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+        '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+class Predicate(object):
+    '''
+    a boolean test over the entries of a meta data table
+    '''
+    def __and__(self, other):
+        return _Combination(numpy.logical_and, self, other)
+
+    def __or__(self, other):
+        return _Combination(numpy.logical_or, self, other)
+
+    def __invert__(self):
+        return _Negation(self)
+
+    def mask(self, index):
+        '''
+        return a boolean array with an entry for each row of the MetaIndex index
+        '''
+        raise NotImplementedError
+
+class _Comparison(Predicate):
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return 'Field(%r) %s %r' % (self.field, self.op, self.value)
+
+    def mask(self, index):
+        return index.compare(self.field, self.op, self.value)
+
+class _Combination(Predicate):
+    def __init__(self, combine, left, right):
+        self.combine = combine
+        self.left = left
+        self.right = right
+
+    def mask(self, index):
+        return self.combine(self.left.mask(index), self.right.mask(index))
+
+class _Negation(Predicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def mask(self, index):
+        return numpy.logical_not(self.predicate.mask(index))
+
+class Field(object):
+    '''
+    a named meta data field, compared to values to build predicates
+    '''
+    __hash__ = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return _Comparison(self.name, '==', value)
+
+    def __ne__(self, value):
+        return _Comparison(self.name, '!=', value)
+
+    def __lt__(self, value):
+        return _Comparison(self.name, '<', value)
+
+    def __le__(self, value):
+        return _Comparison(self.name, '<=', value)
+
+    def __gt__(self, value):
+        return _Comparison(self.name, '>', value)
+
+    def __ge__(self, value):
+        return _Comparison(self.name, '>=', value)
+
+    def isin(self, values):
+        return _Comparison(self.name, 'in', list(values))
+
+    def between(self, low, high):
+        '''
+        inclusive range test
+        '''
+        return (self >= low) & (self <= high)
+
+class MetaIndex(object):
+    '''
+    typed, indexed view of a meta data table with an 'ind' column, as stored
+    by GCT. Fields are typed on first use and cached.
+    '''
+    def __init__(self, table):
+        self.table = table
+        self.inds = table['ind'].values.astype(numpy.int64)
+        self._fields = {}
+
+    def _get_field(self, name):
+        '''
+        return ('numeric', values) or ('categorical', (codes, categories))
+        '''
+        if name not in self._fields:
+            values = self.table[name].values
+            if values.dtype.kind in 'biuf':
+                self._fields[name] = ('numeric', values)
+            else:
+                values = _as_text(values)
+                numbers = pd.to_numeric(pd.Series(values), errors='coerce')
+                if len(values) and not numbers.isnull().any():
+                    self._fields[name] = ('numeric', numbers.values)
+                else:
+                    codes, categories = pd.factorize(values, sort=True)
+                    self._fields[name] = ('categorical', (codes, pd.Index(categories)))
+        return self._fields[name]
+
+    def compare(self, name, op, value):
+        '''
+        return a boolean mask of the entries of field name that satisfy op value
+        '''
+        kind, data = self._get_field(name)
+        if kind == 'numeric':
+            if op == 'in':
+                return numpy.in1d(data, numpy.asarray(value, dtype=float))
+            return _ops[op](data, float(value))
+
+        codes, categories = data
+        if op == 'in':
+            value_codes = categories.get_indexer([str(x) for x in value])
+            return numpy.in1d(codes, value_codes[value_codes >= 0])
+        # categories are sorted, so text comparisons become code comparisons.
+        # missing values have code -1 and never match
+        value = str(value)
+        position = categories.searchsorted(value)
+        present = position < len(categories) and categories[position] == value
+        valid = codes >= 0
+        if op == '==':
+            return codes == position if present else numpy.zeros(len(codes), dtype=bool)
+        if op == '!=':
+            return valid & (codes != position) if present else valid
+        if op == '<':
+            return valid & (codes < position)
+        if op == '<=':
+            return valid & (codes < position + present)
+        if op == '>':
+            return codes >= position + present
+        if op == '>=':
+            return codes >= position
+        raise ValueError('unsupported operator %s' % (op,))
+
+    def query(self, predicate):
+        '''
+        return a numpy array of the 'ind' values of entries matching predicate
+        '''
+        return self.inds[predicate.mask(self)]
+
+def _as_text(values):
+    '''
+    convert an object array of text to str, decoding bytes under python 3
+    '''
+    if len(values) and isinstance(values[0], bytes) and bytes is not str:
+        return numpy.char.decode(values.astype(bytes), 'utf-8').astype(object)
+    return values.astype(str).astype(object)
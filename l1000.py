@@ -1,5 +1,12 @@
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+
 import pandas
 import numpy
+import scipy.sparse
 
 def url_to_df(path):
     """Takes url for gzipped tsv files and returns a dataframe."""
@@ -18,24 +25,285 @@ def extract_from_gctx(path, probes, signatures):
     gct_object.read_gctx_matrix(cid = signatures, rid = probes)
     return pandas.DataFrame(gct_object.matrix, index=probes, columns=signatures)
 
-def probes_to_genes(df, probe_to_gene):
-    """Converts probe level dataframe to gene level dataframe."""
-    get_gene = lambda probe: probe_to_gene.get(probe)
-    grouped = df.groupby(by=get_gene, axis=0)
-    gene_df = grouped.mean()
-    return gene_df
+def probes_to_genes(df, probe_to_gene=None, gene_operator=None):
+    """
+    Converts probe level dataframe to gene level dataframe by averaging the
+    probes of each gene. Probes without a gene are dropped and genes are
+    sorted. Pass `gene_operator` from `get_gene_operator` to reuse it across
+    dataframes with the same probes instead of `probe_to_gene`. Rows of `df`
+    are reordered to the probes of `gene_operator` if needed.
+    """
+    if gene_operator is None:
+        gene_operator = get_gene_operator(df.index, probe_to_gene)
+    genes, operator, probes = gene_operator
+    if not df.index.equals(probes):
+        if len(df.index) != len(probes) or not probes.isin(df.index).all():
+            raise ValueError('df has different probes than gene_operator')
+        df = df.loc[probes]
+    gene_matrix = collapse_probes(df.values, operator)
+    return pandas.DataFrame(gene_matrix, index=genes, columns=df.columns)
 
-def get_consensus_signatures(df, pert_to_sigs, weighting_subset=False):
+def get_gene_operator(probes, probe_to_gene):
+    """
+    Build the probe to gene averaging operator for the sequence of `probes`.
+    Returns the sorted genes, a gene (rows) by probe (columns) sparse matrix
+    whose rows hold 1 / n for the n probes of each gene, so that averaging
+    any probe by column matrix is a single matrix product, and the probes as
+    a pandas.Index giving the order of the operator's columns.
+    """
+    probes = pandas.Index(probes)
+    probe_genes = pandas.Series([probe_to_gene.get(probe) for probe in probes], dtype=object)
+    # probes without a gene (None or NaN) are coded -1 and dropped
+    codes, genes = pandas.factorize(probe_genes, sort=True)
+    probe_positions = numpy.flatnonzero(codes >= 0)
+    codes = codes[probe_positions]
+    counts = numpy.bincount(codes, minlength=len(genes))
+    operator = scipy.sparse.csr_matrix(
+        (1.0 / counts[codes], (codes, probe_positions)),
+        shape=(len(genes), len(probes)))
+    return list(genes), operator, probes
+
+def collapse_probes(matrix, operator):
+    """
+    Average the rows of a probe by column numpy array `matrix` into gene rows
+    using `operator` from `get_gene_operator`. As with a groupby mean, missing
+    values are ignored when averaging.
+    """
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    missing = numpy.isnan(matrix)
+    if not missing.any():
+        return operator.dot(matrix)
+    indicator = (operator != 0).astype(numpy.float64)
+    sums = indicator.dot(numpy.where(missing, 0.0, matrix))
+    counts = indicator.dot((~missing).astype(numpy.float64))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def get_consensus_signatures(df, pert_to_sigs, weighting_subset=False, chunk_size=1000,
+                             n_jobs=1, temp_dir=None, gene_expr_df=None):
     """
     Compute consensus signatures for pertubagens specified in `pert_to_sigs`,
     which is a dictionary of context_id to sig_id list. `df` is a probe (rows)
     by signature (columns) dataframe. `weighting_subset` is a subset of probes
-    to use for weighting, for example all landmark probes.
+    to use for weighting, for example all landmark probes. All consensuses are
+    computed as a single sparse product of `df` with a signature (rows) by
+    perturbagen (columns) weight matrix, processing `chunk_size` probes at a
+    time. Returns a probe by perturbagen dataframe with sorted columns.
+
+    With `n_jobs` greater than 1 (or -1 for all cores), perturbagens are split
+    across a process pool. Workers memory-map the probe by signature matrix
+    from a .npy file in `temp_dir` rather than receiving a pickled copy. The
+    result is identical to the serial computation.
+
+    `gene_expr_df` is an optional gene by signature dataframe collapsed from
+    `df` with `probes_to_genes`. Weights are still computed from the probes
+    of `df`, but the consensuses are computed over the rows of `gene_expr_df`
+    and a gene by perturbagen dataframe is returned. Since Stouffer's method is
+    linear once the weights are fixed, this equals collapsing the probe
+    consensuses afterwards (barring missing values), while the consensus
+    product runs over fewer rows and the collapsed matrix can be shared by
+    several calls.
+    """
+    perts = sorted(pert_to_sigs)
+    weighting_df = df if weighting_subset is False else df.loc[weighting_subset, :]
+    weighting_matrix = weighting_df.values
+    ranked_matrix = rank_signatures(weighting_matrix)
+    # signatures with missing weighting values need their raw values
+    if not numpy.isnan(ranked_matrix).any():
+        weighting_matrix = None
+    if gene_expr_df is not None:
+        # weights follow the column order of df, so gene_expr_df must match it
+        if not gene_expr_df.columns.equals(df.columns):
+            if (len(gene_expr_df.columns) != len(df.columns) or
+                    not df.columns.isin(gene_expr_df.columns).all()):
+                raise ValueError('gene_expr_df has different signatures than df')
+            gene_expr_df = gene_expr_df[df.columns]
+        df = gene_expr_df
+    sig_positions = [df.columns.get_indexer(pert_to_sigs[pert]) for pert in perts]
+    if sig_positions and (numpy.concatenate(sig_positions) < 0).any():
+        missing = sorted(set(sig for pert, positions in zip(perts, sig_positions)
+                             for sig, position in zip(pert_to_sigs[pert], positions)
+                             if position < 0))
+        raise KeyError('signatures not in df: {}'.format(missing[:10]))
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    elif n_jobs < 1:
+        raise ValueError('n_jobs must be a positive integer or -1')
+    if not perts:
+        return pandas.DataFrame(numpy.empty((len(df), 0)), index=df.index, columns=perts)
+    if n_jobs == 1:
+        weight_matrix = build_weight_matrix(ranked_matrix, sig_positions, weighting_matrix)
+        consensus_matrix = apply_weight_matrix(df.values, weight_matrix, chunk_size=chunk_size)
+    else:
+        consensus_matrix = _get_consensus_matrix_parallel(
+            df.values, ranked_matrix, sig_positions, n_jobs, chunk_size, temp_dir,
+            weighting_matrix)
+    return pandas.DataFrame(consensus_matrix, index=df.index, columns=perts)
+
+def compare_consensus_orders(df, pert_to_sigs, gene_operator, weighting_subset=False):
+    """
+    Compute gene level consensus signatures by collapsing probes to genes
+    after the consensus step (the original order) and before it, and return
+    a dictionary reporting the largest absolute difference between the two,
+    the seconds taken by each and the bytes of the matrix each consensus
+    product runs over. The gene first timing includes collapsing `df`.
+    """
+    import time
+    start = time.time()
+    probe_consensus_df = get_consensus_signatures(df, pert_to_sigs, weighting_subset)
+    after_df = probes_to_genes(probe_consensus_df, gene_operator=gene_operator)
+    after_seconds = time.time() - start
+
+    start = time.time()
+    gene_expr_df = probes_to_genes(df, gene_operator=gene_operator)
+    before_df = get_consensus_signatures(df, pert_to_sigs, weighting_subset, gene_expr_df=gene_expr_df)
+    before_seconds = time.time() - start
+
+    return {
+        'max_abs_difference': float(numpy.nanmax(numpy.abs(after_df.values - before_df.values))),
+        'collapse_after_seconds': after_seconds,
+        'collapse_before_seconds': before_seconds,
+        'collapse_after_matrix_bytes': df.values.nbytes,
+        'collapse_before_matrix_bytes': gene_expr_df.values.nbytes,
+    }
+
+def get_consensus_signatures_from_gctx(path, probes, pert_to_sigs, weighting_subset=False,
+                                      batch_size=2000, chunk_size=1000):
+    """
+    Compute consensus signatures as `get_consensus_signatures` does, but
+    stream signatures from the gctx file at `path` instead of requiring a
+    probe by signature dataframe of every signature in memory. Perturbagens
+    are ordered by the on-disk position of their first signature and grouped
+    into batches of about `batch_size` signatures. Each batch reads only its
+    columns (in on-disk order), computes its consensuses and drops the
+    columns, so peak memory is bounded by the largest batch or perturbagen.
+    """
+    import cmap.io.gct
+    gct_object = cmap.io.gct.GCT(path)
+    probes = list(probes)
+    sigs = sorted(set(itertools.chain.from_iterable(pert_to_sigs.values())))
+    sig_to_ind = dict(zip(sigs, gct_object.get_gctx_cid_inds(path, match_list=sigs)))
+    ind_to_sig = {ind: sig for sig, ind in sig_to_ind.items()}
+    row_inds = gct_object.get_gctx_rid_inds(path, match_list=probes)
+
+    perts = sorted(pert_to_sigs)
+    pert_to_position = {pert: i for i, pert in enumerate(perts)}
+    disk_order = sorted(perts, key=lambda pert: min(sig_to_ind[sig] for sig in pert_to_sigs[pert]))
+    consensus_matrix = numpy.empty((len(probes), len(perts)))
+    for batch in _batch_perts(disk_order, pert_to_sigs, batch_size):
+        batch_to_sigs = {pert: pert_to_sigs[pert] for pert in batch}
+        col_inds = sorted(set(sig_to_ind[sig] for sig in itertools.chain.from_iterable(batch_to_sigs.values())))
+        gct_object.read_gctx_matrix(src=path, col_inds=col_inds, row_inds=row_inds, verbose=False)
+        batch_df = pandas.DataFrame(gct_object.matrix, index=probes, columns=[ind_to_sig[ind] for ind in col_inds])
+        gct_object.matrix = ''
+        batch_consensus_df = get_consensus_signatures(
+            batch_df, batch_to_sigs, weighting_subset=weighting_subset, chunk_size=chunk_size)
+        del batch_df
+        positions = [pert_to_position[pert] for pert in batch_consensus_df.columns]
+        consensus_matrix[:, positions] = batch_consensus_df.values
+    return pandas.DataFrame(consensus_matrix, index=probes, columns=perts)
+
+def _batch_perts(perts, pert_to_sigs, batch_size):
+    """
+    Split `perts` into consecutive batches of at most `batch_size` signatures.
+    A perturbagen with more signatures than `batch_size` forms its own batch.
     """
-    consensuses = dict()
-    for pert, sigs in pert_to_sigs.items():
-        consensuses[pert] = get_consensus_signature(df.loc[:, sigs], weighting_subset=weighting_subset)
-    return pandas.DataFrame(consensuses)
+    batch, n_sigs = list(), 0
+    for pert in perts:
+        pert_n_sigs = len(pert_to_sigs[pert])
+        if batch and n_sigs + pert_n_sigs > batch_size:
+            yield batch
+            batch, n_sigs = list(), 0
+        batch.append(pert)
+        n_sigs += pert_n_sigs
+    if batch:
+        yield batch
+
+def _get_consensus_matrix_parallel(matrix, ranked_matrix, sig_positions, n_jobs, chunk_size,
+                                   temp_dir=None, weighting_matrix=None):
+    """
+    Compute the consensus matrix in a process pool. Perturbagens are split
+    into contiguous parts, so concatenating the parts keeps the column order.
+    """
+    temp_dir = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        matrix_path = os.path.join(temp_dir, 'matrix.npy')
+        ranked_path = os.path.join(temp_dir, 'ranked.npy')
+        numpy.save(matrix_path, matrix)
+        numpy.save(ranked_path, ranked_matrix)
+        weighting_path = None
+        if weighting_matrix is not None:
+            weighting_path = os.path.join(temp_dir, 'weighting.npy')
+            numpy.save(weighting_path, weighting_matrix)
+        n_parts = min(len(sig_positions), 4 * n_jobs)
+        bounds = numpy.linspace(0, len(sig_positions), n_parts + 1).astype(int)
+        tasks = [(matrix_path, ranked_path, weighting_path, sig_positions[i:j], chunk_size)
+                 for i, j in zip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            parts = pool.map(_consensus_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(temp_dir)
+    return numpy.concatenate(parts, axis=1)
+
+def _consensus_worker(task):
+    """
+    Compute consensuses for a part of the perturbagens from memory-mapped
+    matrices, reading only the signatures the part uses.
+    """
+    matrix_path, ranked_path, weighting_path, sig_positions, chunk_size = task
+    matrix = numpy.load(matrix_path, mmap_mode='r')
+    ranked_matrix = numpy.load(ranked_path, mmap_mode='r')
+    columns, local_positions = numpy.unique(numpy.concatenate(sig_positions), return_inverse=True)
+    splits = numpy.cumsum([len(positions) for positions in sig_positions])[:-1]
+    local_positions = numpy.split(local_positions, splits)
+    weighting_matrix = None
+    if weighting_path is not None:
+        weighting_matrix = numpy.load(weighting_path, mmap_mode='r')[:, columns]
+    weight_matrix = build_weight_matrix(ranked_matrix[:, columns], local_positions, weighting_matrix)
+    return apply_weight_matrix(matrix[:, columns], weight_matrix, chunk_size=chunk_size)
+
+def build_weight_matrix(ranked_matrix, sig_positions, weighting_matrix=None):
+    """
+    Build the sparse Stouffer weight matrix from a `ranked_matrix` returned by
+    `rank_signatures` and a list with the signature column positions of each
+    perturbagen. Signatures with missing values have NaN ranks, so
+    perturbagens with any are weighted by pairwise complete Spearman
+    correlations of the unranked `weighting_matrix` instead.
+    """
+    rows, cols, values = list(), list(), list()
+    for j, positions in enumerate(sig_positions):
+        assert (positions >= 0).all()
+        ranks = ranked_matrix[:, positions]
+        if weighting_matrix is not None and numpy.isnan(ranks).any():
+            weights = weight_signature(pandas.DataFrame(weighting_matrix[:, positions]))
+        else:
+            weights = weight_signature(ranks, ranked=True)
+        rows.append(positions)
+        cols.append(numpy.repeat(j, len(positions)))
+        values.append(weights / numpy.sqrt(numpy.sum(weights ** 2)))
+    shape = ranked_matrix.shape[1], len(sig_positions)
+    # duplicate entries, from signatures listed twice for a perturbagen, are summed
+    weight_matrix = scipy.sparse.coo_matrix(
+        (numpy.concatenate(values), (numpy.concatenate(rows), numpy.concatenate(cols))), shape=shape)
+    return weight_matrix.tocsc()
+
+def apply_weight_matrix(matrix, weight_matrix, chunk_size=1000):
+    """
+    Multiply a probe by signature `matrix` by a sparse signature by
+    perturbagen `weight_matrix`. Probes are processed `chunk_size` rows at a
+    time to limit the memory used by upcasting to float64.
+    """
+    n_probes = matrix.shape[0]
+    weight_matrix_t = weight_matrix.transpose().tocsr()
+    consensus_matrix = numpy.empty((n_probes, weight_matrix.shape[1]))
+    for start in range(0, n_probes, chunk_size):
+        block = matrix[start:start + chunk_size, :]
+        consensus_matrix[start:start + chunk_size, :] = weight_matrix_t.dot(block.transpose()).transpose()
+    return consensus_matrix
 
 def get_consensus_signature(df, weighting_subset=False):
     """
@@ -43,34 +311,134 @@ def get_consensus_signature(df, weighting_subset=False):
     """
     weighting_df = df if weighting_subset is False else df.loc[weighting_subset, :]
     weights = weight_signature(weighting_df)
-    consensus = df.apply(stouffer, axis='columns', weights=weights)
+    consensus = pandas.Series(stouffer(df.values, weights), index=df.index)
     return consensus
 
 def stouffer(z_scores, weights):
     """
     Meta-analyze z_scores using Stouffer's method.
     See https://doi.org/10.15363/thinklab.d43#5
+    `z_scores` can be a vector or a matrix with a row per probe, in which case
+    all rows are combined in a single matrix-vector product.
     """
-    assert len(z_scores) == len(weights)
-    z_scores = numpy.array(z_scores)
+    z_scores = numpy.asarray(z_scores)
     weights = numpy.array(weights)
-    return numpy.sum(z_scores * weights) / numpy.sqrt(numpy.sum(weights ** 2))
+    assert z_scores.shape[-1] == len(weights)
+    return numpy.dot(z_scores, weights) / numpy.sqrt(numpy.sum(weights ** 2))
 
-def weight_signature(df, min_cor = 0.05):
+def rank_signatures(matrix):
+    """
+    Rank each signature (column) of a probe by signature `matrix` and scale
+    the centered ranks to unit length. The Spearman correlation between two
+    signatures is then the dot product of their columns. Ties receive their
+    average rank, as in `pandas.DataFrame.corr(method='spearman')`.
+    """
+    ranks = pandas.DataFrame(matrix).rank().values
+    ranks = ranks - ranks.mean(axis=0)
+    return ranks / numpy.sqrt(numpy.sum(ranks ** 2, axis=0))
+
+def weight_signature(df, min_cor = 0.05, ranked=False):
     """
     Calculate a weight for each signature that equals a signature's average
     correlation to other signatures. `min_cor` sets a minimum correlation to
     prevent signatures from having zero or negative weights. `df` is probe
     (rows) by signature (columns) dataframe. Returns a numpy.array of weights.
+    If `ranked`, `df` is a dataframe or numpy.array already transformed by
+    `rank_signatures`, and correlations are computed as a matrix product.
     """
-    if len(df.columns) == 1:
+    n_sigs = df.shape[1]
+    if n_sigs == 1:
         return numpy.array([1])
 
-    if len(df.columns) == 2:
+    if n_sigs == 2:
         return numpy.array([0.5, 0.5])
 
-    corr_df = df.corr(method='spearman')
-    mean_cor = (corr_df.sum(axis='rows') - 1) / (len(corr_df) - 1)
+    if ranked:
+        ranks = numpy.asarray(df)
+        corr_matrix = numpy.dot(ranks.transpose(), ranks)
+    else:
+        corr_matrix = df.corr(method='spearman').values
+    mean_cor = (numpy.nansum(corr_matrix, axis=0) - 1) / (n_sigs - 1)
     weights = numpy.maximum(mean_cor, min_cor)
     weights /= weights.sum()
-    return numpy.array(weights)
+    return weights
+
+def write_consensi_gctx(pert_expr_df, path):
+    """
+    Write a perturbagen (rows) by gene (columns) consensus dataframe to a
+    gctx file at `path`. The matrix is stored uncompressed and contiguously as
+    float32, with perturbagens as the gctx columns (`/0/META/COL/id`) and
+    genes as the gctx rows (`/0/META/ROW/id`), so it can be memory-mapped by
+    `read_consensi_gctx` or read with `cmap.io.gct`.
+    """
+    import warnings
+    import tables
+    matrix = numpy.ascontiguousarray(pert_expr_df.values, dtype=numpy.float32)
+    perturbagens = numpy.array([str(x) for x in pert_expr_df.index])
+    genes = numpy.array([str(x) for x in pert_expr_df.columns])
+    with warnings.catch_warnings():
+        # gctx group names such as '0' are not valid python identifiers
+        warnings.simplefilter('ignore')
+        h5_file = tables.openFile(path, mode='w')
+        try:
+            h5_file.setNodeAttr('/', 'version', 'GCTX1.0')
+            h5_file.createGroup('/0/DATA', '0', createparents=True)
+            h5_file.createArray('/0/DATA/0', 'matrix', matrix)
+            h5_file.createGroup('/0/META', 'COL', createparents=True)
+            h5_file.createArray('/0/META/COL', 'id', perturbagens)
+            h5_file.createGroup('/0/META', 'ROW', createparents=True)
+            h5_file.createArray('/0/META/ROW', 'id', genes)
+        finally:
+            h5_file.close()
+
+def read_consensi_gctx(path, perturbagens=None, genes=None):
+    """
+    Read a perturbagen by gene consensus dataframe written by
+    `write_consensi_gctx`. The matrix is memory-mapped when h5py is
+    available, so selecting `perturbagens` (rows) and `genes` (columns) only
+    reads the data they cover. Without a selection, the returned dataframe
+    is backed by the read-only memory map. Perturbagen ids that are all
+    integers, such as entrez gene ids, are returned as integers, as
+    `pandas.read_table` would for the tsv consensi.
+    """
+    import tables
+    import cmap.io.gctx_memmap
+    matrix = cmap.io.gctx_memmap.open_matrix_memmap(path)
+    h5_file = tables.openFile(path, mode='r')
+    try:
+        pert_ids = _decode_ids(h5_file.getNode('/0/META/COL/id').read())
+        gene_ids = _decode_ids(h5_file.getNode('/0/META/ROW/id').read())
+        if matrix is None:
+            matrix = h5_file.getNode('/0/DATA/0/matrix').read()
+    finally:
+        h5_file.close()
+
+    try:
+        pert_index = pandas.Index(pandas.to_numeric(pert_ids), name='perturbagen')
+    except ValueError:
+        pert_index = pandas.Index(pert_ids, name='perturbagen')
+    gene_index = pandas.Index(gene_ids)
+
+    rows = _get_positions(pert_index, perturbagens)
+    columns = _get_positions(gene_index, genes)
+    if rows is not None:
+        matrix, pert_index = matrix[rows], pert_index[rows]
+    if columns is not None:
+        matrix, gene_index = matrix[:, columns], gene_index[columns]
+    return pandas.DataFrame(matrix, index=pert_index, columns=gene_index, copy=False)
+
+def _decode_ids(ids):
+    """Convert an array of stored ids to a list of stripped str."""
+    if bytes is not str:
+        ids = [x.decode('utf-8') if isinstance(x, bytes) else x for x in ids]
+    return [str(x).rstrip() for x in ids]
+
+def _get_positions(index, labels):
+    """Return the positions of `labels` in `index`, or None for no selection."""
+    if labels is None:
+        return None
+    positions = index.get_indexer(list(labels))
+    if (positions == -1).any():
+        missing = [label for label, position in zip(labels, positions) if position == -1]
+        raise KeyError('not in consensi: {}'.format(missing[:10]))
+    return positions
@@ -0,0 +1,237 @@
+"""
+Significant dysregulation of genes by perturbagens, computed directly on
+perturbagen by gene matrices of consensus z-scores.
+
+P-values and Bonferroni corrections are computed for whole blocks of
+perturbagens at once. Measured and imputed genes are corrected separately,
+selected by column masks. For imputed genes only the `max_imputed` most
+significant per perturbagen are kept, chosen by partial selection. Only the
+surviving perturbagen-gene pairs are converted to a tidy dataframe.
+"""
+import numpy
+import pandas
+import scipy.sparse
+import scipy.stats
+
+def get_p_values(z_scores):
+    """Two-sided p-values of a numpy.array of z-scores."""
+    return 2 * scipy.stats.norm.cdf(-numpy.abs(z_scores))
+
+def bonferroni(p_values, n_tests, alpha=0.05):
+    """
+    Bonferroni adjust `p_values`, where `n_tests` is the number of tests of
+    each value (a scalar or an array broadcasting against `p_values`).
+    Returns a boolean array of rejected hypotheses and the corrected
+    p-values, as `statsmodels.sandbox.stats.multicomp.multipletests` would.
+    """
+    with numpy.errstate(invalid='ignore'):
+        reject = p_values <= alpha / n_tests
+    p_corrected = numpy.minimum(p_values * n_tests, 1)
+    return reject, p_corrected
+
+def get_significant(z_matrix, measured, alpha=0.05, max_imputed=1000):
+    """
+    Find significant pairs in a perturbagen (rows) by gene (columns) numpy
+    array of z-scores. `measured` is a boolean array that is True for the
+    columns of measured genes and False for imputed genes. Each status is
+    Bonferroni corrected for its own number of genes. All significant
+    measured genes are kept, but only the `max_imputed` most significant
+    imputed genes of each perturbagen. Returns a boolean array of kept pairs
+    and the -log10 Bonferroni p-values.
+    """
+    measured = numpy.asarray(measured, dtype=bool)
+    n_tests = numpy.where(measured, measured.sum(), (~measured).sum())
+    reject, p_corrected = bonferroni(get_p_values(z_matrix), n_tests, alpha)
+    with numpy.errstate(divide='ignore'):
+        nlog10_p = -numpy.log10(p_corrected)
+
+    imputed_columns = numpy.flatnonzero(~measured)
+    imputed_reject = reject[:, imputed_columns]
+    rows = numpy.flatnonzero(imputed_reject.sum(axis=1) > max_imputed)
+    if len(rows):
+        # keep the max_imputed largest -log10 p-values of each crowded row
+        scores = numpy.where(imputed_reject[rows], nlog10_p[rows][:, imputed_columns], -numpy.inf)
+        top = numpy.argpartition(-scores, max_imputed - 1, axis=1)[:, :max_imputed]
+        kept = numpy.zeros(scores.shape, dtype=bool)
+        kept[numpy.arange(len(rows))[:, numpy.newaxis], top] = True
+        imputed_reject[rows] = kept
+        reject[:, imputed_columns] = imputed_reject
+    return reject, nlog10_p
+
+def process_matrix_df(z_matrix_df, gene_df, alpha=0.05, max_imputed=1000, chunk_size=1000):
+    """
+    Take a perturbagen by gene dataframe and extract significantly
+    dysregulated pairs. `gene_df` has `entrez_gene_id`, `symbol` and `status`
+    ('measured' or 'imputed') columns; genes missing from it are ignored.
+    Perturbagens are processed `chunk_size` at a time. Returns `signif_df`
+    with a row per dysregulated pair and `summary_df` which counts the number
+    of dysregulated genes per perturbation.
+    """
+    gene_df = gene_df.drop_duplicates('entrez_gene_id').set_index('entrez_gene_id')
+    genes = [gene for gene in z_matrix_df.columns if gene in gene_df.index]
+    gene_df = gene_df.loc[genes, ['symbol', 'status']]
+    if not gene_df.status.isin(['measured', 'imputed']).all():
+        raise ValueError('Invalid status')
+    measured = (gene_df.status == 'measured').values
+    z_matrix = z_matrix_df[genes].values
+    genes = numpy.array(genes, dtype=object)
+
+    signif_dfs = []
+    for start in range(0, len(z_matrix), chunk_size):
+        z_block = z_matrix[start:start + chunk_size]
+        keep, nlog10_p = get_significant(z_block, measured, alpha, max_imputed)
+        rows, columns = numpy.nonzero(keep)
+        z_scores = z_block[rows, columns]
+        signif_dfs.append(pandas.DataFrame({
+            'perturbagen': z_matrix_df.index.values[start + rows],
+            'entrez_gene_id': genes[columns],
+            'z_score': z_scores,
+            'symbol': gene_df.symbol.values[columns],
+            'status': gene_df.status.values[columns],
+            'direction': numpy.where(z_scores > 0, 'up', 'down'),
+            'nlog10_bonferroni_pval': nlog10_p[rows, columns],
+        }))
+    columns = ['perturbagen', 'entrez_gene_id', 'z_score', 'symbol', 'status',
+               'direction', 'nlog10_bonferroni_pval']
+    if signif_dfs:
+        signif_df = pandas.concat(signif_dfs, ignore_index=True)[columns]
+    else:
+        signif_df = pandas.DataFrame(columns=columns)
+    signif_df = signif_df.sort_values(['perturbagen', 'symbol'], kind='mergesort')
+    signif_df = signif_df.reset_index(drop=True)
+    return signif_df, summarize(signif_df)
+
+def summarize(signif_df):
+    """
+    Count the dysregulated genes of each perturbagen by direction and status,
+    with a column for each direction-status pair, such as `down-imputed`.
+    """
+    columns = ['down-imputed', 'down-measured', 'up-imputed', 'up-measured']
+    kinds = signif_df.direction + '-' + signif_df.status
+    summary_df = pandas.crosstab(signif_df.perturbagen, kinds)
+    summary_df = summary_df.reindex(columns=columns, fill_value=0).astype(int)
+    summary_df.columns.name = None
+    return summary_df.reset_index()
+
+class DysregulationStore(object):
+    """
+    Significant dysregulation as a sparse perturbagen (rows) by gene (columns)
+    matrix of signed -log10 Bonferroni p-values, positive for up-regulation
+    and negative for down-regulation. A CSR copy answers queries by
+    perturbagen and a CSC copy answers queries by gene, each with a slice of
+    the compressed arrays.
+    """
+    def __init__(self, matrix, perturbagens, genes, measured, csc=None):
+        """
+        `matrix` is a scipy.sparse perturbagen by gene matrix, `perturbagens`
+        and `genes` its row and column ids, and `measured` a boolean array
+        that is True for measured genes and False for imputed genes. `csc` is
+        an optional CSC copy of `matrix`, built from it when not given.
+        """
+        self.csr = scipy.sparse.csr_matrix(matrix, dtype=numpy.float32)
+        self.csc = self.csr.tocsc() if csc is None else scipy.sparse.csc_matrix(csc)
+        self.perturbagens = _as_id_array(perturbagens)
+        self.genes = _as_id_array(genes)
+        self.measured = numpy.asarray(measured, dtype=bool)
+        self._pert_to_row = {pert: i for i, pert in enumerate(self.perturbagens.tolist())}
+        self._gene_to_column = {gene: i for i, gene in enumerate(self.genes.tolist())}
+
+    @classmethod
+    def from_signif_df(cls, signif_df, gene_df):
+        """
+        Build a store from the tidy output of `process_matrix_df`. Rows are
+        the perturbagens with significant genes and columns all the genes of
+        `gene_df`, as str entrez gene ids.
+        """
+        perturbagens = numpy.unique(signif_df.perturbagen.values)
+        genes = gene_df.entrez_gene_id.astype(str).values
+        rows = pandas.Index(perturbagens).get_indexer(signif_df.perturbagen.values)
+        columns = pandas.Index(genes).get_indexer(signif_df.entrez_gene_id.astype(str).values)
+        if (columns == -1).any():
+            raise ValueError('signif_df has genes missing from gene_df')
+        signs = numpy.where(signif_df.direction.values == 'up', 1.0, -1.0)
+        values = signs * signif_df.nlog10_bonferroni_pval.values
+        matrix = scipy.sparse.coo_matrix((values, (rows, columns)),
+                                         shape=(len(perturbagens), len(genes)))
+        measured = (gene_df.status == 'measured').values
+        return cls(matrix, perturbagens, genes, measured)
+
+    def save(self, path):
+        """Save the store to the numpy .npz archive at `path`."""
+        numpy.savez(
+            path,
+            csr_data=self.csr.data, csr_indices=self.csr.indices, csr_indptr=self.csr.indptr,
+            csc_data=self.csc.data, csc_indices=self.csc.indices, csc_indptr=self.csc.indptr,
+            shape=numpy.array(self.csr.shape), perturbagens=self.perturbagens,
+            genes=self.genes, measured=self.measured)
+
+    @classmethod
+    def load(cls, path):
+        """Load a store saved with `save`, without rebuilding either copy."""
+        with numpy.load(path) as archive:
+            shape = tuple(archive['shape'])
+            csr = scipy.sparse.csr_matrix(
+                (archive['csr_data'], archive['csr_indices'], archive['csr_indptr']), shape=shape)
+            csc = scipy.sparse.csc_matrix(
+                (archive['csc_data'], archive['csc_indices'], archive['csc_indptr']), shape=shape)
+            return cls(csr, archive['perturbagens'], archive['genes'], archive['measured'], csc=csc)
+
+    def get_genes(self, perturbagen, direction=None):
+        """
+        Return the genes dysregulated by `perturbagen` and their signed
+        -log10 p-values, optionally only those of `direction` ('up' or
+        'down'). Perturbagens without significant genes return empty arrays.
+        """
+        row = self._pert_to_row.get(perturbagen)
+        if row is None:
+            return self.genes[:0], numpy.empty(0, dtype=numpy.float32)
+        start, stop = self.csr.indptr[row], self.csr.indptr[row + 1]
+        return _select(self.genes, self.csr.indices[start:stop],
+                       self.csr.data[start:stop], direction)
+
+    def get_perturbagens(self, gene, direction=None):
+        """
+        Return the perturbagens that dysregulate `gene` (a str entrez gene id)
+        and their signed -log10 p-values, optionally only those of
+        `direction` ('up' or 'down'). Unknown genes return empty arrays.
+        """
+        column = self._gene_to_column.get(gene)
+        if column is None:
+            return self.perturbagens[:0], numpy.empty(0, dtype=numpy.float32)
+        start, stop = self.csc.indptr[column], self.csc.indptr[column + 1]
+        return _select(self.perturbagens, self.csc.indices[start:stop],
+                       self.csc.data[start:stop], direction)
+
+    def summarize(self):
+        """
+        Count the dysregulated genes of each perturbagen by direction and
+        status, in the format of `summarize`.
+        """
+        rows = numpy.repeat(numpy.arange(self.csr.shape[0]), numpy.diff(self.csr.indptr))
+        measured = self.measured[self.csr.indices]
+        up = self.csr.data > 0
+        n_rows = self.csr.shape[0]
+        summary_df = pandas.DataFrame({'perturbagen': self.perturbagens})
+        for column, mask in [('down-imputed', ~up & ~measured), ('down-measured', ~up & measured),
+                             ('up-imputed', up & ~measured), ('up-measured', up & measured)]:
+            summary_df[column] = numpy.bincount(rows[mask], minlength=n_rows)
+        return summary_df
+
+def _as_id_array(ids):
+    """Convert ids to a numpy array that can be saved without pickling."""
+    ids = numpy.asarray(ids)
+    if ids.dtype.kind == 'O':
+        ids = ids.astype(str)
+    return ids
+
+def _select(ids, positions, values, direction):
+    """Return the ids at `positions` and `values`, filtered by `direction`."""
+    if direction == 'up':
+        keep = values > 0
+    elif direction == 'down':
+        keep = values < 0
+    elif direction is None:
+        return ids[positions], values
+    else:
+        raise ValueError("direction must be 'up', 'down' or None")
+    return ids[positions[keep]], values[keep]
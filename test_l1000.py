@@ -0,0 +1,32 @@
+import numpy
+import pandas
+
+import l1000
+
+def test_consensus_signatures_with_missing_weighting_value():
+    """
+    A missing value in the weighting probes is handled as by
+    `get_consensus_signature`, with pairwise complete correlations.
+    """
+    rng = numpy.random.RandomState(0)
+    probes = ['probe_{}'.format(i) for i in range(60)]
+    sigs = ['sig_{}'.format(i) for i in range(12)]
+    df = pandas.DataFrame(rng.randn(60, 12), index=probes, columns=sigs)
+    df['sig_0'] += df['sig_1']
+    df.loc['probe_3', 'sig_1'] = numpy.nan
+    landmarks = probes[:30]
+    pert_to_sigs = {'a': sigs[:4], 'b': sigs[4:7], 'c': sigs[7:]}
+    expected = pandas.DataFrame({
+        pert: l1000.get_consensus_signature(df[pert_sigs], weighting_subset=landmarks)
+        for pert, pert_sigs in pert_to_sigs.items()})
+    for n_jobs in 1, 2:
+        consensus_df = l1000.get_consensus_signatures(
+            df, pert_to_sigs, weighting_subset=landmarks, n_jobs=n_jobs)
+        numpy.testing.assert_allclose(consensus_df.values, expected[consensus_df.columns].values)
+
+def test_consensus_signatures_without_perturbagens():
+    df = pandas.DataFrame(numpy.random.RandomState(0).randn(3, 2), index=['a', 'b', 'c'], columns=['x', 'y'])
+    for n_jobs in 1, 2:
+        consensus_df = l1000.get_consensus_signatures(df, {}, n_jobs=n_jobs)
+        assert consensus_df.shape == (3, 0)
+        assert consensus_df.index.equals(df.index)
@@ -0,0 +1,337 @@
+"""
+Map L1000 compounds to external resources by InChIKey with UniChem.
+
+`UniChemMapper` queries the UniChem REST `key_search` endpoint concurrently.
+Requests are limited by a semaphore (`concurrency`) and a token bucket
+(`rate` requests per second), and every response is cached in a sqlite
+database keyed by the queried key, so reruns only query new keys. As in
+`unichem.ipynb`, a full InChIKey without matches is retried with its first
+block (the connection layer). Mappings are returned as rows of the
+`unichem` table and written with `write_mapping` in a single transaction.
+
+The base URL is configurable, so the mapper can run against a local stub
+server. Requires python 3.
+
+`UniChemDump` maps offline instead, from a local UniChem-style dump of
+InChIKey to source compound ids. All compounds are resolved at once with
+binary searches of sorted indexes on the full InChIKey and on its first
+block, with the same first block fallback.
+
+example usage:
+mapper = UniChemMapper('data/unichem-cache.db', id_to_source=unichem.id_to_source)
+map_df = mapper.map_perts(pert_df)
+write_mapping(connection, map_df)
+
+dump = UniChemDump.read('data/unichem-dump.tsv.gz', unichem.id_to_source, pert_df.inchi_key)
+map_df = dump.map_perts(pert_df)
+"""
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+
+import numpy
+import pandas
+
+default_base_url = 'https://www.ebi.ac.uk/unichem/rest'
+
+# UniChem match flags of the unichem table
+match_columns = ['C', 'b', 'i', 'm', 'p', 's', 't']
+unichem_columns = ['pert_uid', 'query_inchi_key', 'resource', 'resource_id'] + match_columns
+
+class TokenBucket(object):
+    """
+    Allow `rate` acquisitions per second on average, with bursts of up to
+    `capacity`.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ResponseCache(object):
+    """
+    UniChem responses stored in a sqlite database, keyed by query key and
+    assignment. Writes are committed by `flush`.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'query_key TEXT, assignment INTEGER, response TEXT, '
+            'PRIMARY KEY (query_key, assignment))')
+        self.connection.commit()
+
+    def get(self, key, assignment):
+        """Return the cached decoded response for `key`, or None."""
+        row = self.connection.execute(
+            'SELECT response FROM responses WHERE query_key = ? AND assignment = ?',
+            (key, assignment)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, assignment, response):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?,?,?)',
+            (key, assignment, json.dumps(response)))
+
+    def flush(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+class UniChemMapper(object):
+    """
+    Concurrent, rate limited UniChem key searches with an on-disk response
+    cache. `id_to_source` maps UniChem src_ids to resource names, such as
+    `unichem.id_to_source`.
+    """
+    def __init__(self, cache_path, id_to_source, base_url=default_base_url,
+                 concurrency=8, rate=5.0, assignment=4, timeout=60, retries=3):
+        self.cache = ResponseCache(cache_path)
+        self.id_to_source = {str(k): v for k, v in id_to_source.items()}
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.assignment = assignment
+        self.timeout = timeout
+        self.retries = retries
+        self.n_requests = 0
+
+    def _fetch(self, key):
+        """Blocking GET of the key search for `key`, decoded from JSON."""
+        url = '{}/key_search/{}/{}'.format(self.base_url, key, self.assignment)
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    async def key_search(self, key, limiter):
+        """
+        Return the list of UniChem matches for `key`, from the cache if
+        possible. Error responses (no matches) are cached as empty lists;
+        failed requests are retried with exponential backoff and not cached.
+        """
+        cached = self.cache.get(key, self.assignment)
+        if cached is not None:
+            return cached
+        semaphore, bucket, executor = limiter
+        loop = asyncio.get_event_loop()
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                await bucket.acquire()
+                self.n_requests += 1
+                try:
+                    response = await loop.run_in_executor(executor, self._fetch, key)
+                    break
+                except urllib.error.HTTPError as error:
+                    if error.code < 500 or attempt == self.retries:
+                        raise
+                except (urllib.error.URLError, OSError):
+                    if attempt == self.retries:
+                        raise
+                await asyncio.sleep(2 ** attempt)
+        # UniChem reports keys without matches as error objects
+        if not isinstance(response, list):
+            response = [response]
+        matches = [match for match in response if 'src_id' in match]
+        self.cache.put(key, self.assignment, matches)
+        return matches
+
+    async def map_inchi_key(self, inchi_key, limiter):
+        """
+        Return the matches for a full InChIKey, falling back to its first
+        block when there are none.
+        """
+        matches = await self.key_search(inchi_key, limiter)
+        if not matches:
+            matches = await self.key_search(inchi_key.split('-')[0], limiter)
+        return matches
+
+    async def map_inchi_keys_async(self, inchi_keys):
+        """Return a dictionary of InChIKey to UniChem matches."""
+        limiter = (asyncio.Semaphore(self.concurrency), TokenBucket(self.rate),
+                   concurrent.futures.ThreadPoolExecutor(self.concurrency))
+        inchi_keys = list(inchi_keys)
+        try:
+            results = await asyncio.gather(
+                *[self.map_inchi_key(key, limiter) for key in inchi_keys])
+        finally:
+            limiter[2].shutdown(wait=False)
+            self.cache.flush()
+        return dict(zip(inchi_keys, results))
+
+    def map_inchi_keys(self, inchi_keys):
+        """Blocking version of `map_inchi_keys_async`."""
+        return _run(self.map_inchi_keys_async(inchi_keys))
+
+    def map_perts(self, pert_df):
+        """
+        Map the compounds of `pert_df`, a dataframe with `pert_uid` and
+        `inchi_key` columns, returning a dataframe of `unichem` table rows.
+        """
+        key_to_matches = self.map_inchi_keys(pert_df.inchi_key.unique())
+        rows = list()
+        for pert_uid, inchi_key in zip(pert_df.pert_uid, pert_df.inchi_key):
+            for match in key_to_matches[inchi_key]:
+                resource = self.id_to_source.get(str(match.get('src_id')))
+                if resource is None:
+                    continue
+                row = [int(pert_uid), match.get('Query_InChIKey', inchi_key),
+                       resource, str(match['src_compound_id'])]
+                row.extend(match.get(column) for column in match_columns)
+                rows.append(row)
+        return pandas.DataFrame(rows, columns=unichem_columns)
+
+    def close(self):
+        self.cache.close()
+
+def _run(coroutine):
+    """
+    Run `coroutine` to completion on a new event loop in its own thread, so
+    it also works where a loop is already running, as in Jupyter.
+    """
+    def run_in_new_loop():
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(run_in_new_loop).result()
+
+def write_mapping(connection, map_df, table='unichem'):
+    """
+    Insert the rows of `map_df` into the `unichem` table in a single
+    transaction.
+    """
+    query = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join(unichem_columns), ', '.join('?' * len(unichem_columns)))
+    rows = map_df[unichem_columns].astype(object).where(map_df[unichem_columns].notnull(), None)
+    with connection:
+        connection.executemany(query, rows.values.tolist())
+
+class UniChemDump(object):
+    """
+    A local UniChem-style dump of InChIKey to source compound ids, with sorted
+    indexes on the full InChIKey and on its first block (the connection
+    layer). `dump_df` has `inchi_key` and `resource_id` columns, a `resource`
+    or `src_id` column, and optionally any of the match columns.
+    """
+    def __init__(self, dump_df, id_to_source=None):
+        dump_df = dump_df.rename(columns=dump_column_aliases)
+        if 'resource' not in dump_df:
+            if id_to_source is None:
+                raise ValueError('id_to_source is required for a dump without a resource column')
+            id_to_source = {str(k): v for k, v in id_to_source.items()}
+            dump_df['resource'] = dump_df.src_id.astype(str).map(id_to_source)
+        dump_df = dump_df[dump_df.resource.notnull() & dump_df.inchi_key.notnull()]
+        keys = numpy.asarray(dump_df.inchi_key, dtype=str)
+        self.dump_df = dump_df.reset_index(drop=True)
+        self.key_order = numpy.argsort(keys, kind='mergesort')
+        self.sorted_keys = keys[self.key_order]
+        blocks = keys.astype('U14')
+        self.block_order = numpy.argsort(blocks, kind='mergesort')
+        self.sorted_blocks = blocks[self.block_order]
+
+    @classmethod
+    def read(cls, path, id_to_source=None, inchi_keys=None, sep='\t', chunk_size=10**6):
+        """
+        Read a dump from a delimited (optionally compressed) file at `path`.
+        When `inchi_keys` are given, only rows sharing a first block with one
+        of them are kept, so large dumps are filtered while they are read.
+        """
+        blocks = None if inchi_keys is None else {key.split('-')[0] for key in inchi_keys}
+        dump_dfs = list()
+        for chunk in pandas.read_csv(path, sep=sep, dtype=str, chunksize=chunk_size):
+            chunk = chunk.rename(columns=dump_column_aliases)
+            if blocks is not None:
+                chunk = chunk[chunk.inchi_key.str[:14].isin(blocks)]
+            dump_dfs.append(chunk)
+        return cls(pandas.concat(dump_dfs, ignore_index=True), id_to_source)
+
+    def map_perts(self, pert_df):
+        """
+        Map the compounds of `pert_df`, a dataframe with `pert_uid` and
+        `inchi_key` columns, returning a dataframe of `unichem` table rows.
+        As with key searches, compounds whose full InChIKey is missing from
+        the dump are matched on its first block, and `query_inchi_key` is the
+        key that matched. Match columns missing from the dump are inferred
+        from the InChIKeys, where 0 means the layer matches: an identical key
+        matches every layer, and a first block match matches the connection
+        layer (C), matches protonation (p) when the protonation characters
+        agree, and matches the layers of the second block (b, i, m, s, t)
+        only when the second blocks agree.
+        """
+        pert_uids = pert_df.pert_uid.values
+        queries = numpy.asarray(pert_df.inchi_key, dtype=str)
+        counts, query_positions, positions = _search_sorted(self.sorted_keys, queries)
+        positions = self.key_order[positions]
+        missed = numpy.flatnonzero(counts == 0)
+        block_queries = queries[missed].astype('U14')
+        block_counts, block_query_positions, block_positions = _search_sorted(
+            self.sorted_blocks, block_queries)
+        query_positions = numpy.concatenate([query_positions, missed[block_query_positions]])
+        positions = numpy.concatenate([positions, self.block_order[block_positions]])
+        fallback = numpy.arange(len(positions)) >= len(positions) - len(block_positions)
+
+        matched_df = self.dump_df.iloc[positions].reset_index(drop=True)
+        pert_keys = queries[query_positions]
+        map_df = pandas.DataFrame({
+            'pert_uid': pert_uids[query_positions].astype(int),
+            'query_inchi_key': numpy.where(fallback, pert_keys.astype('U14'), pert_keys),
+            'resource': matched_df.resource.values,
+            'resource_id': matched_df.resource_id.astype(str).values,
+        })
+        dump_keys = numpy.asarray(matched_df.inchi_key, dtype=str)
+        same_second = pert_keys.astype('U23') == dump_keys.astype('U23')
+        same_proton = (pandas.Series(pert_keys).str[-1:].values ==
+                       pandas.Series(dump_keys).str[-1:].values)
+        for column in match_columns:
+            if column in matched_df:
+                map_df[column] = pandas.to_numeric(matched_df[column]).values
+                continue
+            if column == 'C':
+                differs = numpy.zeros(len(map_df), dtype=bool)
+            elif column == 'p':
+                differs = fallback & ~same_proton
+            else:
+                differs = fallback & ~same_second
+            map_df[column] = differs.astype(int)
+        map_df = map_df.sort_values(['pert_uid', 'resource', 'resource_id'], kind='mergesort')
+        return map_df.reset_index(drop=True)
+
+# column names of UniChem dumps and their names in UniChemDump
+dump_column_aliases = {
+    'standardinchikey': 'inchi_key',
+    'StandardInChIKey': 'inchi_key',
+    'src_compound_id': 'resource_id',
+}
+
+def _search_sorted(sorted_keys, queries):
+    """
+    Find every occurrence of each query in `sorted_keys`. Returns the number
+    of occurrences of each query, and the query and sorted position of each
+    occurrence.
+    """
+    left = numpy.searchsorted(sorted_keys, queries, side='left')
+    right = numpy.searchsorted(sorted_keys, queries, side='right')
+    counts = right - left
+    query_positions = numpy.repeat(numpy.arange(len(queries)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return counts, query_positions, numpy.repeat(left, counts) + offsets